@@ -0,0 +1,49 @@
+"""In-memory кеш готовых ответов API (процесс uvicorn один, поэтому достаточно памяти процесса)."""
+
+import time
+from typing import NamedTuple, Optional
+
+# Каталог инвалидируется явно при каждом изменении (админка, списание/возврат остатков),
+# TTL лишь страхует от правок в БД в обход API.
+CATALOG_CACHE_TTL_SECONDS = 60
+
+
+class CatalogCacheEntry(NamedTuple):
+    """Запись кеша каталога: готовое JSON-тело и ETag лежат в одной записи и пишутся одной операцией."""
+
+    body: bytes
+    etag: str
+    expires_at: float  # дедлайн по time.monotonic()
+
+
+_catalog_entry: Optional[CatalogCacheEntry] = None
+# Поколение кеша: загрузка, начатая до инвалидации, не должна записать устаревшие данные
+_catalog_generation = 0
+
+
+def get_catalog_cache() -> Optional[CatalogCacheEntry]:
+    """Возвращает актуальную запись кеша публичного каталога или None."""
+    entry = _catalog_entry
+    if entry is None or time.monotonic() >= entry.expires_at:
+        return None
+    return entry
+
+
+def get_catalog_generation() -> int:
+    """Возвращает текущее поколение кеша каталога (снимать до загрузки из БД)."""
+    return _catalog_generation
+
+
+def set_catalog_cache(body: bytes, etag: str, generation: int) -> None:
+    """Сохраняет тело каталога и его ETag, если с момента начала загрузки не было инвалидации."""
+    global _catalog_entry
+    if generation != _catalog_generation:
+        return
+    _catalog_entry = CatalogCacheEntry(body, etag, time.monotonic() + CATALOG_CACHE_TTL_SECONDS)
+
+
+def invalidate_catalog_cache() -> None:
+    """Сбрасывает кеш каталога после изменения категорий, товаров или остатков."""
+    global _catalog_entry, _catalog_generation
+    _catalog_entry = None
+    _catalog_generation += 1
@@ -42,6 +42,10 @@ class Settings(BaseSettings):
 
     mongo_uri: str = Field("mongodb://localhost:27017", env="MONGO_URI")
     mongo_db: str = Field("miniapp", env="MONGO_DB")
+    # Пул соединений Motor: один клиент обслуживает и запросы, и GridFS (чеки, изображения)
+    mongo_max_pool_size: int = Field(200, env="MONGO_MAX_POOL_SIZE")
+    mongo_min_pool_size: int = Field(5, env="MONGO_MIN_POOL_SIZE")
+    mongo_max_idle_ms: int = Field(1800000, env="MONGO_MAX_IDLE_MS")
     api_prefix: str = "/api"
     # BaseSettings автоматически загружает переменные окружения по имени поля (case-insensitive)
     # Но для надежности также проверяем ADMIN_IDS в валидаторе
@@ -3,8 +3,9 @@
 import logging
 from typing import Optional
 
-from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
 from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
 
 from .config import settings
 
@@ -12,6 +13,8 @@ logger = logging.getLogger(__name__)
 
 client: AsyncIOMotorClient | None = None
 db: AsyncIOMotorDatabase | None = None
+# Асинхронный GridFS bucket на том же пуле соединений, что и основной клиент
+gridfs_bucket: AsyncIOMotorGridFSBucket | None = None
 _indexes_initialized = False
 _connect_lock: Optional["asyncio.Lock"] = None
 
@@ -26,7 +29,7 @@ def _get_lock():
 
 async def connect_to_mongo():
     """Подключается к MongoDB один раз за процесс. Безопасно вызывать многократно."""
-    global client, db
+    global client, db, gridfs_bucket
     if client is not None and db is not None:
         return
 
@@ -49,12 +52,14 @@ async def connect_to_mongo():
 
             client_config = {
                 "serverSelectionTimeoutMS": 30000,
-                "maxPoolSize": 50,
-                "minPoolSize": 5,
+                # Размеры пула настраиваются через env: при всплесках загрузок и удалений
+                # из GridFS 50 соединений давали ожидание свободного коннекта
+                "maxPoolSize": settings.mongo_max_pool_size,
+                "minPoolSize": settings.mongo_min_pool_size,
                 # Atlas по умолчанию закрывает простаивающие коннекты через ~10 мин.
-                # 30 мин здесь даёт пулу реально переиспользовать соединения и
+                # 30 мин (по умолчанию) здесь даёт пулу реально переиспользовать соединения и
                 # убирает постоянный churn "Connection accepted/ended" в логах.
-                "maxIdleTimeMS": 1800000,
+                "maxIdleTimeMS": settings.mongo_max_idle_ms,
                 "connectTimeoutMS": 20000,
                 "socketTimeoutMS": 60000,
                 "retryWrites": True,
@@ -63,6 +68,10 @@ async def connect_to_mongo():
                 "heartbeatFrequencyMS": 30000,
                 "waitQueueTimeoutMS": 30000,
                 "appname": "dima-miniapp-backend",
+                # Сжатие трафика с Atlas: документы товаров с вариациями и метаданные
+                # заметно ужимаются. zstd (пакет zstandard) предпочтительнее, zlib - встроенный
+                # fallback; недоступный компрессор pymongo пропускает с предупреждением
+                "compressors": "zstd,zlib",
             }
 
             if use_ssl:
@@ -77,12 +86,17 @@ async def connect_to_mongo():
 
             client = new_client
             db = client[settings.mongo_db]
+            gridfs_bucket = AsyncIOMotorGridFSBucket(db)
             await ensure_indexes(db)
-            logger.info("MongoDB connected (pool min=5 max=50, idle=30m, heartbeat=30s)")
+            logger.info(
+                f"MongoDB connected (pool min={settings.mongo_min_pool_size} "
+                f"max={settings.mongo_max_pool_size}, idle={settings.mongo_max_idle_ms}ms, heartbeat=30s)"
+            )
         except Exception as e:
             logger.error(f"Failed to connect to MongoDB: {e}")
             client = None
             db = None
+            gridfs_bucket = None
             return
 
 
@@ -94,11 +108,12 @@ async def ensure_db_connection():
 
 async def close_mongo_connection():
     """Закрывает соединение с MongoDB."""
-    global client, db
+    global client, db, gridfs_bucket
     if client is not None:
         client.close()
     client = None
     db = None
+    gridfs_bucket = None
 
 
 async def get_db() -> Optional[AsyncIOMotorDatabase]:
@@ -109,6 +124,13 @@ async def get_db() -> Optional[AsyncIOMotorDatabase]:
     return db
 
 
+async def get_gridfs_bucket() -> Optional[AsyncIOMotorGridFSBucket]:
+    """Возвращает асинхронный GridFS bucket, созданный один раз при подключении к MongoDB."""
+    if gridfs_bucket is None:
+        await ensure_db_connection()
+    return gridfs_bucket
+
+
 async def ensure_indexes(database: AsyncIOMotorDatabase):
     """Создает необходимые индексы в базе данных."""
     global _indexes_initialized
@@ -132,7 +154,17 @@ async def ensure_indexes(database: AsyncIOMotorDatabase):
     await database.orders.create_index([("user_id", ASCENDING), ("created_at", DESCENDING)])
     await database.orders.create_index([("created_at", DESCENDING)])
     await database.orders.create_index("status")
-    await database.orders.create_index("deleted_at")  # Для фоновой задачи очистки
+    # Для фоновой задачи очистки: частичный индекс только по удаленным заказам (их единицы),
+    # а не запись на каждый заказ. Полный индекс из прошлых версий с тем же ключом удаляем
+    try:
+        await database.orders.drop_index("deleted_at_1")
+    except OperationFailure:
+        pass  # Индекса уже нет
+    await database.orders.create_index(
+        "deleted_at",
+        name="deleted_at_partial",
+        partialFilterExpression={"deleted_at": {"$exists": True}},
+    )
     await database.orders.create_index([("status", ASCENDING), ("created_at", DESCENDING)])  # Для админки
     await database.orders.create_index([("status", ASCENDING), ("updated_at", ASCENDING)])  # Для автоудаления выполненных/отмененных заказов
 
@@ -5,13 +5,13 @@ import gzip
 import io
 import json
 import logging
-from datetime import datetime, timedelta
+from datetime import timedelta
 from pathlib import Path
 
 from fastapi import FastAPI, HTTPException, Request, status
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from pymongo.errors import AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError
 from starlette.concurrency import iterate_in_threadpool
@@ -22,10 +22,36 @@ from .config import settings, ENV_PATH
 from .database import close_mongo_connection, connect_to_mongo, get_db
 from .routers import admin, bot_webhook, cart, catalog, orders, store
 from .routers.cart import cleanup_expired_carts_periodic
+from .routers.store import cleanup_legacy_store_status_fields, warm_store_status_cache
 from .schemas import CatalogResponse, OrderStatus, StoreStatus
-from .utils import close_gridfs_client, permanently_delete_order_entry
+from .utils import permanently_delete_order_entries, shutdown_executors, spawn_background_task, utcnow
+
+# Используем orjson если доступен, иначе fallback на стандартный json
+try:
+    import orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
+# SSE-событие статуса для fallback-стрима неизменно, поэтому сериализуем его один раз
+_FALLBACK_STATUS_DATA = {"is_sleep_mode": False, "sleep_message": None}
+_FALLBACK_STATUS_EVENT = (
+    b"event: status\ndata: "
+    + (
+        orjson.dumps(_FALLBACK_STATUS_DATA)
+        if HAS_ORJSON
+        else json.dumps(_FALLBACK_STATUS_DATA, ensure_ascii=False).encode("utf-8")
+    )
+    + b"\n\n"
+)
 
-app = FastAPI(title="Mini Shop Telegram Backend", version="1.0.0")
+# Ответы эндпоинтов с response_model кодируем через orjson (быстрее стандартного json)
+app = FastAPI(
+    title="Mini Shop Telegram Backend",
+    version="1.0.0",
+    default_response_class=ORJSONResponse if HAS_ORJSON else JSONResponse,
+)
 
 
 # Обработчик ошибок валидации запросов
@@ -87,11 +113,7 @@ async def http_exception_handler(request: Request, exc: HTTPException):
         # Для /api/store/status/stream возвращаем простой стрим с fallback данными
         if path == "/api/store/status/stream":
             async def fallback_stream():
-                fallback_data = {
-                    "is_sleep_mode": False,
-                    "sleep_message": None,
-                }
-                yield f"event: status\ndata: {json.dumps(fallback_data, ensure_ascii=False)}\n\n"
+                yield _FALLBACK_STATUS_EVENT
                 # Отправляем одно сообщение и закрываем стрим
                 await asyncio.sleep(0.1)
 
@@ -173,11 +195,7 @@ async def global_exception_handler(request: Request, exc: Exception):
 
     if path == "/api/store/status/stream":
         async def fallback_stream():
-            fallback_data = {
-                "is_sleep_mode": False,
-                "sleep_message": None,
-            }
-            yield f"event: status\ndata: {json.dumps(fallback_data, ensure_ascii=False)}\n\n"
+            yield _FALLBACK_STATUS_EVENT
             await asyncio.sleep(0.1)
 
         response = StreamingResponse(fallback_stream(), media_type="text/event-stream")
@@ -196,7 +214,7 @@ class SafeGZipMiddleware(BaseHTTPMiddleware):
     """
     Собственная реализация GZip, которая не ломается на закрытых стримах.
 
-    Пропускает SSE/streaming/HEAD/304 ответы.
+    Пропускает SSE/streaming/HEAD/304 ответы и изображения.
     """
 
     def __init__(self, app, minimum_size: int = 1000):
@@ -214,6 +232,10 @@ class SafeGZipMiddleware(BaseHTTPMiddleware):
             return response
         if isinstance(response, StreamingResponse) or (getattr(response, "media_type", None) == "text/event-stream"):
             return response
+        # Изображения уже сжаты: gzip не уменьшит их, но заставит буферизовать
+        # весь потоковый ответ (например, /product/image) в памяти
+        if response.headers.get("content-type", "").startswith("image/"):
+            return response
 
         accept_encoding = request.headers.get("accept-encoding", "")
         if "gzip" not in accept_encoding.lower():
@@ -355,9 +377,6 @@ async def apply_security_and_cache_headers(request, call_next):
         # Каталог кэшируется на 10 минут для максимальной производительности
         response.headers["Cache-Control"] = "public, max-age=600, stale-while-revalidate=120"
         response.headers["Vary"] = "Accept-Encoding"
-    elif path.startswith("/api/store/status"):
-        # Статус магазина кэшируется на 1 минуту
-        response.headers["Cache-Control"] = "public, max-age=60, stale-while-revalidate=20"
     elif path.startswith("/assets/") or path.endswith((".js", ".css", ".png", ".jpg", ".svg", ".woff2")):
         # Статические файлы кэшируются на 1 год
         response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
@@ -380,7 +399,7 @@ async def cleanup_orders():
     while True:
         try:
             # Вычисляем время до следующего запуска (3:00 ночи UTC)
-            now = datetime.utcnow()
+            now = utcnow()
             # Время следующего запуска: сегодня в 3:00, или завтра в 3:00 если уже прошло
             next_run = now.replace(hour=3, minute=0, second=0, microsecond=0)
             if next_run <= now:
@@ -404,6 +423,8 @@ async def cleanup_orders():
             logger.info("Начало автоматической очистки заказов")
             total_deleted = 0
             batch_size = 100
+            # Для удаления нужны только _id и ссылка на чек
+            purge_projection = {"_id": 1, "payment_receipt_file_id": 1}
 
             # 1. Удаляем заказы, помеченные администратором как удаленные
             # (любые заказы с deleted_at, независимо от статуса)
@@ -413,25 +434,27 @@ async def cleanup_orders():
             
             deleted_by_admin_count = 0
             while True:
-                deleted_orders = await db.orders.find(deleted_orders_query).limit(batch_size).to_list(length=batch_size)
+                deleted_orders = await db.orders.find(deleted_orders_query, purge_projection).limit(batch_size).to_list(length=batch_size)
                 
                 if not deleted_orders:
                     break
                 
-                for order_doc in deleted_orders:
-                    try:
-                        await permanently_delete_order_entry(db, order_doc)
-                        deleted_by_admin_count += 1
-                        total_deleted += 1
-                    except (AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError):
-                        logger.warning("Проблемы с подключением к БД, прерываем обработку батча")
-                        break
-                    except Exception as e:
-                        logger.error(f"Ошибка при удалении заказа, помеченного администратором {order_doc.get('_id')}: {e}")
+                # Весь батч удаляется одним набором запросов; при ошибке прерываем этап,
+                # иначе тот же батч выбирался бы снова и снова
+                try:
+                    deleted_count = await permanently_delete_order_entries(db, deleted_orders)
+                except (AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError):
+                    logger.warning("Проблемы с подключением к БД, прерываем обработку батча")
+                    break
+                except Exception as e:
+                    logger.error(f"Ошибка при удалении заказов, помеченных администратором: {e}")
+                    break
+                deleted_by_admin_count += deleted_count
+                total_deleted += deleted_count
 
             # 2. Удаляем выполненные/отмененные заказы, обновленные более суток назад
             # (только те, которые НЕ помечены как удаленные администратором)
-            cutoff_time = datetime.utcnow() - timedelta(days=1)
+            cutoff_time = utcnow() - timedelta(days=1)
             
             completed_orders_query = {
                 "status": {"$in": [OrderStatus.ACCEPTED.value, OrderStatus.REJECTED.value]},
@@ -441,28 +464,22 @@ async def cleanup_orders():
             
             completed_orders_count = 0
             while True:
-                completed_orders = await db.orders.find(completed_orders_query).limit(batch_size).to_list(length=batch_size)
+                # updated_at с $lte в запросе уже исключает заказы без этого поля или с null
+                completed_orders = await db.orders.find(completed_orders_query, purge_projection).limit(batch_size).to_list(length=batch_size)
                 
                 if not completed_orders:
                     break
                 
-                for order_doc in completed_orders:
-                    try:
-                        order_id = str(order_doc.get("_id"))
-                        # Дополнительная проверка: убеждаемся, что updated_at существует и не None
-                        updated_at = order_doc.get("updated_at")
-                        if updated_at is None:
-                            logger.warning(f"Заказ {order_id} не имеет поля updated_at, пропускаем")
-                            continue
-                        
-                        await permanently_delete_order_entry(db, order_doc)
-                        completed_orders_count += 1
-                        total_deleted += 1
-                    except (AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError):
-                        logger.warning("Проблемы с подключением к БД, прерываем обработку батча")
-                        break
-                    except Exception as e:
-                        logger.error(f"Ошибка при удалении выполненного/отмененного заказа {order_doc.get('_id')}: {e}")
+                try:
+                    deleted_count = await permanently_delete_order_entries(db, completed_orders)
+                except (AutoReconnect, NetworkTimeout, ServerSelectionTimeoutError):
+                    logger.warning("Проблемы с подключением к БД, прерываем обработку батча")
+                    break
+                except Exception as e:
+                    logger.error(f"Ошибка при удалении выполненных/отмененных заказов: {e}")
+                    break
+                completed_orders_count += deleted_count
+                total_deleted += deleted_count
 
             # Логируем результаты
             if total_deleted > 0:
@@ -498,11 +515,23 @@ async def startup():
     # Подключаемся к MongoDB при старте для быстрого первого запроса
     await connect_to_mongo()
 
+    # Разовая очистка устаревших полей статуса магазина (вместо очистки на каждом чтении)
+    try:
+        await cleanup_legacy_store_status_fields(await get_db())
+    except Exception as e:
+        logger.warning(f"Не удалось очистить устаревшие поля статуса магазина: {e}")
+
+    # Прогреваем кеш статуса магазина: первый запрос /store/status отдается из памяти
+    try:
+        await warm_store_status_cache(await get_db())
+    except Exception as e:
+        logger.warning(f"Не удалось прогреть кеш статуса магазина: {e}")
+
     # Запускаем фоновую задачу для автоматической очистки заказов (раз в день)
-    asyncio.create_task(cleanup_orders())
+    spawn_background_task(cleanup_orders(), "очистка заказов")
 
     # Запускаем фоновую задачу для очистки просроченных корзин
-    asyncio.create_task(cleanup_expired_carts_periodic())
+    spawn_background_task(cleanup_expired_carts_periodic(), "очистка просроченных корзин")
 
     # Настраиваем webhook для Telegram Bot API (если указан публичный URL)
     logger = logging.getLogger(__name__)
@@ -553,10 +582,7 @@ async def shutdown():
     except Exception as e:
         logger.error(f"Ошибка при закрытии соединения с MongoDB: {e}")
 
-    try:
-        close_gridfs_client()
-    except Exception as e:
-        logger.error(f"Ошибка при закрытии sync GridFS клиента MongoDB: {e}")
+    shutdown_executors()
 
 
 app.include_router(catalog.router, prefix=settings.api_prefix)
@@ -7,11 +7,11 @@ from pathlib import Path
 
 import httpx
 from bson import ObjectId
-from gridfs import GridFS
 from motor.motor_asyncio import AsyncIOMotorDatabase
 
 from .config import get_settings
-from .utils import get_gridfs
+from .database import get_gridfs_bucket
+from .utils import get_gridfs_content_type
 
 logger = logging.getLogger(__name__)
 
@@ -148,15 +148,12 @@ async def notify_admins_new_order(
     receipt_content_type = None
     if receipt_file_id:
         try:
-            # Используем синхронный GridFS клиент через утилиту
-            fs = get_gridfs()
-            loop = asyncio.get_event_loop()
-
-            # Получаем файл из GridFS (синхронная операция в executor)
-            grid_file = await loop.run_in_executor(None, lambda: fs.get(ObjectId(receipt_file_id)))
-            receipt_data = await loop.run_in_executor(None, grid_file.read)
+            # Читаем чек через асинхронный GridFS bucket (без executor и sync-клиента)
+            bucket = await get_gridfs_bucket()
+            grid_file = await bucket.open_download_stream(ObjectId(receipt_file_id))
+            receipt_data = await grid_file.read()
             receipt_filename = grid_file.filename or "receipt"
-            receipt_content_type = grid_file.content_type or "application/octet-stream"
+            receipt_content_type = get_gridfs_content_type(grid_file, "application/octet-stream")
 
             if not receipt_data:
                 receipt_data = None
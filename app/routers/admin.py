@@ -1,20 +1,24 @@
 """Admin router for managing orders and broadcasting messages."""
 
 import asyncio
+import json
 import logging
 from datetime import datetime
+from collections import deque
 from typing import List, Optional
 
 import httpx
 from bson import ObjectId
 from fastapi import APIRouter, Depends, HTTPException, Query, Response, status
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo import ReturnDocument
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
 
 from ..auth import verify_admin
 from ..config import get_settings
-from ..database import get_db
+from ..database import get_db, get_gridfs_bucket
 from ..notifications import notify_customer_order_status
 from ..schemas import (
     BroadcastRequest,
@@ -24,20 +28,63 @@ from ..schemas import (
     OrderSummary,
     PaginatedOrdersResponse,
     UpdateStatusRequest,
+    has_required_fields,
 )
 from ..utils import (
     as_object_id,
-    get_gridfs,
+    get_gridfs_content_type,
     mark_order_as_deleted,
-    restore_variant_quantity,
+    object_id_cache_stats,
+    restore_variant_quantities,
     serialize_doc,
+    spawn_background_task,
+    utcnow,
 )
 
+# Используем orjson если доступен, иначе fallback на стандартный json
+try:
+    import orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
+
 logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["admin"])
 
 
+# Значения статуса, допустимые в OrderSummary (None - поле отсутствует, в схеме есть значение по умолчанию)
+_ORDER_STATUS_VALUES = [order_status.value for order_status in OrderStatus]
+_ORDER_SUMMARY_STR_FIELDS = ("customer_name", "customer_phone", "delivery_address")
+
+
+def _is_valid_order_summary_row(doc: dict) -> bool:
+    """
+    Дешевая проверка строки списка заказов вместо валидации OrderSummary.
+
+    Строки отдаются клиенту без Pydantic, поэтому старые заказы с пропущенными полями
+    или неверными типами нужно отсеять здесь. Значение статуса проверяется фильтром запроса.
+    """
+    if not has_required_fields(OrderSummary, doc):
+        return False
+    if "status" in doc and doc["status"] is None:
+        return False
+    if not all(type(doc[field]) is str and doc[field] for field in _ORDER_SUMMARY_STR_FIELDS):
+        return False
+    if type(doc["total_amount"]) not in (int, float) or doc["total_amount"] < 0:
+        return False
+    created_at = doc.get("created_at")
+    return created_at is None or type(created_at) is datetime
+
+
+def _json_response(payload: dict) -> Response:
+    """JSON-ответ через orjson (datetime сериализуется нативно), иначе через jsonable_encoder."""
+    if HAS_ORJSON:
+        return ORJSONResponse(payload)
+    return JSONResponse(jsonable_encoder(payload))
+
+
 @router.get("/admin/orders", response_model=PaginatedOrdersResponse)
 async def list_orders(
     status_filter: Optional[OrderStatus] = Query(None, alias="status"),
@@ -52,6 +99,9 @@ async def list_orders(
     query = {}
     if status_filter:
         query["status"] = status_filter.value
+    else:
+        # Заказы со статусом вне OrderStatus нарушили бы схему ответа
+        query["status"] = {"$in": [*_ORDER_STATUS_VALUES, None]}
     if not include_deleted:
         query["deleted_at"] = {"$exists": False}
     if cursor:
@@ -60,16 +110,19 @@ async def list_orders(
         except ValueError:
             raise HTTPException(status_code=400, detail="Некорректный cursor")
 
-    # Проекция: получаем только нужные поля для списка (без items, comment, receipt и т.д.)
+    # Проекция: получаем только нужные поля для списка (без items, comment, receipt и т.д.).
+    # id и items_count считает сама MongoDB (выражения агрегации в проекции find),
+    # поэтому массив items не передается по сети, а в документах нет ObjectId
     projection = {
-        "_id": 1,
+        "_id": 0,
+        "id": {"$toString": "$_id"},
         "customer_name": 1,
         "customer_phone": 1,
         "delivery_address": 1,
         "status": 1,
         "total_amount": 1,
         "created_at": 1,
-        "items": 1,  # Нужен только для подсчета длины, не передаем в ответ
+        "items_count": {"$size": {"$ifNull": ["$items", []]}},
     }
 
     # Используем индекс для быстрой сортировки
@@ -81,26 +134,32 @@ async def list_orders(
         .to_list(length=limit + 1)
     )
 
-    # Оптимизированная валидация заказов - создаем OrderSummary напрямую
+    # Документы уже в формате OrderSummary: отдаем их через orjson без serialize_doc
+    # и Pydantic-валидации (response_model остается для схемы API). Старые заказы
+    # с пропущенными полями или неверными типами пропускаем, чтобы не нарушать схему ответа
     orders = []
     for doc in docs:
-        try:
-            # Подсчитываем количество товаров из items массива
-            items_count = len(doc.get("items", []))
-            # Создаем упрощенный объект без полной валидации Order
-            order_data = serialize_doc(doc) | {"id": str(doc["_id"]), "items_count": items_count}
-            # Удаляем items из данных, т.к. они не нужны в OrderSummary
-            order_data.pop("items", None)
-            orders.append(OrderSummary(**order_data))
-        except Exception as e:
-            logger.warning(f"Failed to parse order {doc.get('_id')}: {e}")
+        if not _is_valid_order_summary_row(doc):
+            logger.warning(f"Failed to parse order {doc.get('id')}: missing or invalid fields")
             continue
+        # Значения по умолчанию OrderSummary для полей, которых нет в старых заказах
+        if "status" not in doc:
+            doc["status"] = OrderStatus.ACCEPTED.value
+        if "created_at" not in doc:
+            doc["created_at"] = utcnow()
+        orders.append(doc)
 
     next_cursor = None
     if len(orders) > limit:
-        next_cursor = orders[limit].id
+        next_cursor = orders[limit]["id"]
         orders = orders[:limit]
-    return PaginatedOrdersResponse(orders=orders, next_cursor=next_cursor)
+    return _json_response({"orders": orders, "next_cursor": next_cursor})
+
+
+@router.get("/admin/cache-stats")
+async def get_cache_stats(_admin_id: int = Depends(verify_admin)):
+    """Статистика внутренних кешей процесса (только для администратора)."""
+    return {"object_id_cache": object_id_cache_stats()}
 
 
 @router.get("/admin/order/{order_id}", response_model=Order)
@@ -132,14 +191,15 @@ async def get_admin_order_receipt(
         raise HTTPException(status_code=404, detail="Чек не найден")
 
     try:
-        fs = get_gridfs()
-        loop = asyncio.get_event_loop()
+        bucket = await get_gridfs_bucket()
+        if bucket is None:
+            raise HTTPException(status_code=503, detail="База данных недоступна")
 
-        # Получаем файл из GridFS (синхронная операция в executor)
-        grid_file = await loop.run_in_executor(None, lambda: fs.get(ObjectId(receipt_file_id)))
-        file_data = await loop.run_in_executor(None, grid_file.read)
+        # Читаем файл через асинхронный GridFS bucket (без executor и sync-клиента)
+        grid_file = await bucket.open_download_stream(ObjectId(receipt_file_id))
+        file_data = await grid_file.read()
         filename = grid_file.filename or "receipt"
-        content_type = grid_file.content_type or "application/octet-stream"
+        content_type = get_gridfs_content_type(grid_file, "application/octet-stream")
 
         return Response(
             content=file_data,
@@ -166,7 +226,7 @@ async def update_order_status(
         raise HTTPException(status_code=404, detail="Заказ не найден")
 
     old_status = old_doc.get("status")
-    new_status = payload.status.value
+    new_status = payload.status
 
     # Валидация: для статуса "отказано" обязательна причина (не пустая строка)
     if new_status == OrderStatus.REJECTED.value:
@@ -178,17 +238,12 @@ async def update_order_status(
 
     # Если заказ отклоняется, возвращаем товары на склад
     if new_status == OrderStatus.REJECTED.value and old_status != OrderStatus.REJECTED.value:
-        items = old_doc.get("items", [])
-        for item in items:
-            if item.get("variant_id"):
-                await restore_variant_quantity(
-                    db, item.get("product_id"), item.get("variant_id"), item.get("quantity", 0)
-                )
+        await restore_variant_quantities(db, old_doc.get("items", []))
 
     update_operations: dict[str, dict] = {
         "$set": {
-            "status": payload.status.value,
-            "updated_at": datetime.utcnow(),
+            "status": new_status,
+            "updated_at": utcnow(),
             "can_edit_address": False,  # Адрес нельзя редактировать после создания
         }
     }
@@ -216,14 +271,15 @@ async def update_order_status(
     if user_id and old_status != new_status:
         try:
             rejection_reason = doc.get("rejection_reason") if new_status == OrderStatus.REJECTED.value else None
-            asyncio.create_task(
+            spawn_background_task(
                 notify_customer_order_status(
                     user_id=user_id,
                     order_id=order_id,
                     order_status=new_status,
                     customer_name=doc.get("customer_name"),
                     rejection_reason=rejection_reason,
-                )
+                ),
+                "уведомление клиента о статусе заказа",
             )
         except Exception as e:
             logger.warning(f"Failed to notify customer: {e}")
@@ -248,7 +304,7 @@ async def quick_accept_order(
     update_ops = {
         "$set": {
             "status": OrderStatus.ACCEPTED.value,
-            "updated_at": datetime.utcnow(),
+            "updated_at": utcnow(),
             "can_edit_address": False,
         }
     }
@@ -297,15 +353,10 @@ async def delete_order(
     _admin_id: int = Depends(verify_admin),
 ):
     """Удаляет заказ (мягкое удаление)."""
-    order_oid = as_object_id(order_id)
-    doc = await db.orders.find_one({"_id": order_oid})
-    if not doc:
-        raise HTTPException(status_code=404, detail="Заказ не найден")
-
-    # Помечаем заказ как удаленный
+    # Помечаем заказ как удаленный: поиск и обновление - один запрос
     deleted = await mark_order_as_deleted(db, order_id)
     if not deleted:
-        raise HTTPException(status_code=400, detail="Не удалось удалить заказ")
+        raise HTTPException(status_code=404, detail="Заказ не найден")
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
@@ -334,7 +385,7 @@ async def send_broadcast(
 
     total_count = await db.customers.count_documents({})
 
-    asyncio.create_task(_run_broadcast(message_text, settings.telegram_bot_token))
+    spawn_background_task(_run_broadcast(message_text, settings.telegram_bot_token), "рассылка")
 
     logger.info(f"Рассылка поставлена в очередь: получателей ~{total_count}")
     return BroadcastResponse(success=True, sent_count=0, total_count=total_count, failed_count=0)
@@ -353,12 +404,26 @@ async def _run_broadcast(message_text: str, bot_token: str) -> None:
     concurrency = 25
     customers_cursor = db.customers.find({}, {"telegram_id": 1})
     bot_api_url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+    # Текст одинаков для всех получателей: кодируем его в JSON один раз на рассылку,
+    # а для каждого получателя только подставляем chat_id
+    encoded_text = json.dumps(message_text, ensure_ascii=False).encode("utf-8")
+    json_headers = {"Content-Type": "application/json"}
     sent_count = 0
     failed_count = 0
     total_count = 0
     invalid_user_ids: list[int] = []
     start_time = time.time()
-    last_send_times: list[float] = []
+    # Времена отправок за последнюю секунду (time.monotonic), старые снимаются слева за O(1)
+    last_send_times: deque[float] = deque()
+
+    def encode_chat_id(telegram_id) -> bytes:
+        # telegram_id в старых записях может быть строкой: кодируем как JSON-значение,
+        # как это делал json= у httpx (Telegram принимает chat_id и числом, и строкой)
+        return json.dumps(telegram_id).encode("utf-8")
+
+    def prune_send_times(now: float) -> None:
+        while last_send_times and now - last_send_times[0] >= 1.0:
+            last_send_times.popleft()
 
     async def send_to_customer_with_retry(
         client: httpx.AsyncClient,
@@ -369,27 +434,25 @@ async def _run_broadcast(message_text: str, bot_token: str) -> None:
         for attempt in range(max_retries):
             try:
                 # Rate limiting: ждем если нужно
-                now = time.time()
+                now = time.monotonic()
                 if last_send_times:
                     # Удаляем старые записи (старше 1 секунды)
-                    last_send_times[:] = [t for t in last_send_times if now - t < 1.0]
+                    prune_send_times(now)
                     
                     # Если достигли лимита (30 в секунду), ждем
                     if len(last_send_times) >= 30:
                         sleep_time = 1.0 - (now - last_send_times[0])
                         if sleep_time > 0:
                             await asyncio.sleep(sleep_time)
-                            now = time.time()
-                            last_send_times[:] = [t for t in last_send_times if now - t < 1.0]
+                            now = time.monotonic()
+                            prune_send_times(now)
                 
                 last_send_times.append(now)
                 
                 response = await client.post(
                     bot_api_url,
-                    json={
-                        "chat_id": telegram_id,
-                        "text": message_text,
-                    },
+                    content=b'{"chat_id":%s,"text":%s}' % (encode_chat_id(telegram_id), encoded_text),
+                    headers=json_headers,
                     timeout=15.0,  # Увеличенный timeout для надежности
                 )
                 result = response.json()
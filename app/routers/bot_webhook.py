@@ -11,7 +11,7 @@ from ..config import get_settings
 from ..database import get_db
 from ..notifications import notify_customer_order_status
 from ..schemas import OrderStatus
-from ..utils import as_object_id, mark_order_as_deleted
+from ..utils import as_object_id, mark_order_as_deleted, restore_variant_quantities, utcnow
 
 router = APIRouter(tags=["bot"])
 
@@ -216,17 +216,8 @@ async def handle_bot_webhook(
                 return {"ok": True}
 
             # Если заказ отклоняется, возвращаем товары на склад
-            from datetime import datetime
-
-            from ..utils import restore_variant_quantity
-
             if new_status_value == OrderStatus.REJECTED.value and current_status != OrderStatus.REJECTED.value:
-                items = doc.get("items", [])
-                for item in items:
-                    if item.get("variant_id"):
-                        await restore_variant_quantity(
-                            db, item.get("product_id"), item.get("variant_id"), item.get("quantity", 0)
-                        )
+                await restore_variant_quantities(db, doc.get("items", []))
 
             old_status = current_status
 
@@ -234,7 +225,7 @@ async def handle_bot_webhook(
             update_operations: dict = {
                 "$set": {
                     "status": new_status_value,
-                    "updated_at": datetime.utcnow(),
+                    "updated_at": utcnow(),
                     "can_edit_address": False,  # Адрес нельзя редактировать после создания
                 }
             }
@@ -310,14 +301,12 @@ async def handle_bot_webhook(
                 return {"ok": True}
 
             # Обновляем статус на "принят"
-            from datetime import datetime
-
             updated = await db.orders.find_one_and_update(
                 {"_id": as_object_id(order_id)},
                 {
                     "$set": {
                         "status": OrderStatus.ACCEPTED.value,
-                        "updated_at": datetime.utcnow(),
+                        "updated_at": utcnow(),
                         "can_edit_address": False,
                     }
                 },
@@ -352,23 +341,14 @@ async def handle_bot_webhook(
                 return {"ok": True}
 
             # Обновляем статус на "отказано" и возвращаем товары на склад
-            from datetime import datetime
-
-            from ..utils import restore_variant_quantity
-
-            items = doc.get("items", [])
-            for item in items:
-                if item.get("variant_id"):
-                    await restore_variant_quantity(
-                        db, item.get("product_id"), item.get("variant_id"), item.get("quantity", 0)
-                    )
+            await restore_variant_quantities(db, doc.get("items", []))
 
             updated = await db.orders.find_one_and_update(
                 {"_id": as_object_id(order_id)},
                 {
                     "$set": {
                         "status": OrderStatus.REJECTED.value,
-                        "updated_at": datetime.utcnow(),
+                        "updated_at": utcnow(),
                         "can_edit_address": False,
                         "rejection_reason": "Отклонено через кнопку в Telegram",
                     }
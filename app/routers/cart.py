@@ -1,18 +1,35 @@
 """Модуль для работы с корзиной покупок."""
 
 import asyncio
+import json
 import logging
 from datetime import datetime, timedelta
 from uuid import uuid4
 
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, Response, status
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo.errors import DuplicateKeyError
 
 from ..database import get_db
 from ..schemas import AddToCartRequest, Cart, RemoveFromCartRequest, UpdateCartItemRequest
 from ..security import TelegramUser, get_current_user
-from ..utils import as_object_id, decrement_variant_quantity, normalize_product_images, restore_variant_quantity, serialize_doc
+from ..utils import (
+    as_object_id,
+    decrement_variant_quantity,
+    normalize_product_images,
+    restore_variant_quantities,
+    restore_variant_quantity,
+    spawn_background_task,
+    utcnow,
+)
+
+# Используем orjson если доступен, иначе fallback на стандартный json
+try:
+    import orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
 # Время жизни корзины в минутах
 CART_EXPIRY_MINUTES = 15
@@ -56,9 +73,10 @@ async def cleanup_expired_cart(db: AsyncIOMotorDatabase, cart: dict):
     if not cart or not cart.get("items"):
         return False
 
+    now = utcnow()
     updated_at = cart.get("updated_at")
     if not updated_at:
-        updated_at = cart.get("created_at", datetime.utcnow())
+        updated_at = cart.get("created_at", now)
 
     # Оптимизированная проверка истечения
     if not isinstance(updated_at, datetime):
@@ -66,18 +84,14 @@ async def cleanup_expired_cart(db: AsyncIOMotorDatabase, cart: dict):
             try:
                 updated_at = datetime.fromisoformat(updated_at.replace("Z", "+00:00"))
             except Exception:
-                updated_at = datetime.utcnow()
+                updated_at = now
         else:
-            updated_at = datetime.utcnow()
+            updated_at = now
     expiry_time = updated_at + timedelta(minutes=CART_EXPIRY_MINUTES)
 
-    if datetime.utcnow() > expiry_time:
+    if now > expiry_time:
         # Возвращаем все товары на склад
-        for item in cart.get("items", []):
-            if item.get("variant_id"):
-                await restore_variant_quantity(
-                    db, item.get("product_id"), item.get("variant_id"), item.get("quantity", 0)
-                )
+        await restore_variant_quantities(db, cart.get("items", []))
 
         # Удаляем корзину
         await db.carts.delete_one({"_id": cart["_id"]})
@@ -112,7 +126,7 @@ async def cleanup_expired_carts_periodic():
 
             # Находим корзины, которые не обновлялись более CART_EXPIRY_MINUTES минут
             # Используем только updated_at (есть индекс) для быстрого поиска
-            cutoff_time = datetime.utcnow() - timedelta(minutes=CART_EXPIRY_MINUTES)
+            cutoff_time = utcnow() - timedelta(minutes=CART_EXPIRY_MINUTES)
             
             # Оптимизированный запрос: используем индекс на updated_at, загружаем только нужные поля
             expired_carts = await db.carts.find(
@@ -173,13 +187,14 @@ async def cleanup_expired_carts_periodic():
 async def get_cart_document(db: AsyncIOMotorDatabase, user_id: int, check_expiry: bool = True):
     """Получает документ корзины пользователя."""
     cart = await db.carts.find_one({"user_id": user_id})
+    now = utcnow()
     if not cart:
         cart = {
             "user_id": user_id,
             "items": [],
             "total_amount": 0,
-            "created_at": datetime.utcnow(),
-            "updated_at": datetime.utcnow(),
+            "created_at": now,
+            "updated_at": now,
         }
         try:
             result = await db.carts.insert_one(cart)
@@ -193,36 +208,33 @@ async def get_cart_document(db: AsyncIOMotorDatabase, user_id: int, check_expiry
                     "user_id": user_id,
                     "items": [],
                     "total_amount": 0,
-                    "created_at": datetime.utcnow(),
-                    "updated_at": datetime.utcnow(),
+                    "created_at": now,
+                    "updated_at": now,
                 }
                 result = await db.carts.insert_one(cart)
                 cart["_id"] = result.inserted_id
     elif check_expiry:
         # Оптимизированная проверка истечения
-        updated_at = cart.get("updated_at") or cart.get("created_at", datetime.utcnow())
+        updated_at = cart.get("updated_at") or cart.get("created_at", now)
         if not isinstance(updated_at, datetime):
             if isinstance(updated_at, str):
                 try:
                     updated_at = datetime.fromisoformat(updated_at.replace("Z", "+00:00"))
                 except Exception:
-                    updated_at = datetime.utcnow()
+                    updated_at = now
             else:
-                updated_at = datetime.utcnow()
+                updated_at = now
 
-        if datetime.utcnow() > updated_at + timedelta(minutes=CART_EXPIRY_MINUTES):
+        if now > updated_at + timedelta(minutes=CART_EXPIRY_MINUTES):
             # Очищаем корзину в фоне, не блокируя ответ
-            cleanup_task = asyncio.create_task(cleanup_expired_cart(db, cart))
-            cleanup_task.add_done_callback(
-                lambda t: logger.warning(f"Background task failed: {t.exception()}") if t.exception() else None
-            )
+            spawn_background_task(cleanup_expired_cart(db, cart), "очистка просроченной корзины")
             # Создаем новую корзину сразу
             cart = {
                 "user_id": user_id,
                 "items": [],
                 "total_amount": 0,
-                "created_at": datetime.utcnow(),
-                "updated_at": datetime.utcnow(),
+                "created_at": now,
+                "updated_at": now,
             }
             try:
                 result = await db.carts.insert_one(cart)
@@ -236,14 +248,34 @@ async def get_cart_document(db: AsyncIOMotorDatabase, user_id: int, check_expiry
                         "user_id": user_id,
                         "items": [],
                         "total_amount": 0,
-                        "created_at": datetime.utcnow(),
-                        "updated_at": datetime.utcnow(),
+                        "created_at": now,
+                        "updated_at": now,
                     }
                     result = await db.carts.insert_one(cart)
                     cart["_id"] = result.inserted_id
     return cart
 
 
+def _cart_response(cart: dict, cart_id: str) -> Response:
+    """
+    Отдает нормализованную корзину в формате Cart без serialize_doc и валидации модели.
+
+    После normalize_cart позиции уже содержат только поля CartItem с JSON-типами;
+    default=str подстрахует старые записи с ObjectId в product_id.
+    """
+    payload = {
+        "id": cart_id,
+        "user_id": cart["user_id"],
+        "items": cart["items"],
+        "total_amount": cart["total_amount"],
+    }
+    if HAS_ORJSON:
+        content = orjson.dumps(payload, default=str)
+    else:
+        content = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+    return Response(content=content, media_type="application/json")
+
+
 def recalculate_total(cart):
     """Пересчитывает общую сумму корзины."""
     cart["total_amount"] = round(
@@ -263,18 +295,14 @@ async def get_cart(
     cart = await get_cart_document(db, user_id, check_expiry=True)
     safe_cart = normalize_cart(cart)
     
-    # Сериализуем документ и убеждаемся, что _id правильно обработан
-    serialized = serialize_doc(safe_cart)
+    # Убеждаемся, что _id правильно обработан
     cart_id = str(cart.get("_id", ""))
     if not cart_id or cart_id == "None":
         raise HTTPException(status_code=500, detail="Ошибка: корзина не имеет идентификатора")
     
-    # Создаем модель Cart, исключая служебные поля, которые не нужны в ответе
-    cart_data = {k: v for k, v in serialized.items() if k not in ("_id", "created_at", "updated_at")}
-    cart_data["id"] = cart_id
-    cart_data["user_id"] = user_id
-    
-    return Cart(**cart_data)
+    # Служебные поля (_id, created_at, updated_at) в ответ не попадают
+    safe_cart["user_id"] = user_id
+    return _cart_response(safe_cart, cart_id)
 
 
 @router.post("/cart", response_model=Cart)
@@ -294,6 +322,8 @@ async def add_to_cart(
     # Для добавления в корзину не нужно проверять истечение (это делается при GET)
     # Используем проекцию для товара - не загружаем лишние поля
     # Включаем и image, и images для нормализации
+    # Из вариаций нужна только выбранная ($elemMatch), а has_variants отличает
+    # товар без вариаций от несуществующей вариации
     product_task = db.products.find_one(
         {"_id": product_oid},
         {
@@ -301,7 +331,8 @@ async def add_to_cart(
             "price": 1,
             "image": 1,
             "images": 1,
-            "variants": 1,
+            "variants": {"$elemMatch": {"id": payload.variant_id}},
+            "has_variants": {"$gt": [{"$size": {"$ifNull": ["$variants", []]}}, 0]},
             "_id": 1,
         },
     )
@@ -316,14 +347,13 @@ async def add_to_cart(
     product = normalize_product_images(product)
 
     # Вариации обязательны для всех товаров
-    variants = product.get("variants", [])
-    if not variants or len(variants) == 0:
+    if not product.get("has_variants"):
         raise HTTPException(
             status_code=400, detail="Товар не может быть продан без вариаций (вкусов). Обратитесь к администратору."
         )
 
     # Проверяем вариацию (variant_id теперь обязателен в схеме, но проверяем существование)
-    variant = next((v for v in variants if v.get("id") == payload.variant_id), None)
+    variant = next(iter(product.get("variants") or []), None)
     if not variant:
         raise HTTPException(status_code=404, detail="Вариация не найдена")
 
@@ -335,7 +365,7 @@ async def add_to_cart(
         variant_quantity = 0
 
     # Используем атомарные операции MongoDB для обновления корзины и списания товара
-    now = datetime.utcnow()
+    now = utcnow()
 
     # Вычисляем изменение total_amount заранее
     price_delta = variant_price * payload.quantity
@@ -428,17 +458,15 @@ async def add_to_cart(
 
     # Обновление клиента в фоне (fire-and-forget для скорости)
     try:
-        customer_task = asyncio.create_task(
-            db.customers.update_one({"telegram_id": user_id}, {"$set": {"last_cart_activity": now}}, upsert=True)
-        )
-        customer_task.add_done_callback(
-            lambda t: logger.warning(f"Background task failed: {t.exception()}") if t.exception() else None
+        spawn_background_task(
+            db.customers.update_one({"telegram_id": user_id}, {"$set": {"last_cart_activity": now}}, upsert=True),
+            "обновление активности клиента",
         )
     except Exception:
         pass  # Игнорируем ошибки
 
     safe_cart = normalize_cart(final_cart)
-    return Cart(**serialize_doc(safe_cart) | {"id": str(final_cart["_id"])})
+    return _cart_response(safe_cart, str(final_cart["_id"]))
 
 
 @router.patch("/cart/item", response_model=Cart)
@@ -449,7 +477,7 @@ async def update_cart_item(
 ):
     """Обновляет количество товара в корзине."""
     user_id = current_user.id
-    now = datetime.utcnow()
+    now = utcnow()
     
     # Получаем только нужные поля корзины для оптимизации
     cart = await db.carts.find_one(
@@ -471,13 +499,14 @@ async def update_cart_item(
         # Количество не изменилось, просто возвращаем корзину
         cart = await get_cart_document(db, user_id, check_expiry=False)
         safe_cart = normalize_cart(cart)
-        return Cart(**serialize_doc(safe_cart) | {"id": str(cart["_id"])})
+        return _cart_response(safe_cart, str(cart["_id"]))
 
     # Обработка изменения количества на складе
     if item.get("variant_id") and quantity_diff != 0:
         product = await db.products.find_one(
             {"_id": as_object_id(item["product_id"])},
-            {"variants": 1}
+            # Только изменяемая вариация, а не весь массив
+            {"variants": {"$elemMatch": {"id": item.get("variant_id")}}}
         )
         if product:
             variant = next((v for v in product.get("variants", []) if v.get("id") == item.get("variant_id")), None)
@@ -525,7 +554,7 @@ async def update_cart_item(
         raise HTTPException(status_code=500, detail="Ошибка при обновлении корзины")
 
     safe_cart = normalize_cart(final_cart)
-    return Cart(**serialize_doc(safe_cart) | {"id": str(final_cart["_id"])})
+    return _cart_response(safe_cart, str(final_cart["_id"]))
 
 
 @router.delete("/cart/item", response_model=Cart)
@@ -536,7 +565,7 @@ async def remove_from_cart(
 ):
     """Удаляет товар из корзины."""
     user_id = current_user.id
-    now = datetime.utcnow()
+    now = utcnow()
     
     # Получаем только нужные поля корзины для оптимизации
     cart = await db.carts.find_one(
@@ -577,7 +606,7 @@ async def remove_from_cart(
         raise HTTPException(status_code=500, detail="Ошибка при удалении товара из корзины")
 
     safe_cart = normalize_cart(final_cart)
-    return Cart(**serialize_doc(safe_cart) | {"id": str(final_cart["_id"])})
+    return _cart_response(safe_cart, str(final_cart["_id"]))
 
 
 @router.delete("/cart", response_model=Cart)
@@ -589,14 +618,12 @@ async def clear_cart(
     cart = await get_cart_document(db, current_user.id, check_expiry=False)
 
     # Возвращаем все товары на склад
-    for item in cart.get("items", []):
-        if item.get("variant_id"):
-            await restore_variant_quantity(db, item.get("product_id"), item.get("variant_id"), item.get("quantity", 0))
+    await restore_variant_quantities(db, cart.get("items", []))
 
     # Очищаем корзину
     cart["items"] = []
     cart["total_amount"] = 0
-    cart["updated_at"] = datetime.utcnow()
+    cart["updated_at"] = utcnow()
     await db.carts.update_one({"_id": cart["_id"]}, {"$set": cart})
     safe_cart = normalize_cart(cart)
-    return Cart(**serialize_doc(safe_cart) | {"id": str(cart["_id"])})
+    return _cart_response(safe_cart, str(cart["_id"]))
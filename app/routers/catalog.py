@@ -9,11 +9,19 @@ from typing import List, Optional, Sequence, Tuple
 
 from bson import ObjectId
 from fastapi import APIRouter, Depends, Header, HTTPException, Response, status
+from fastapi.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
 from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError
 
 from ..auth import verify_admin
-from ..database import get_db
+from ..cache import (
+    get_catalog_cache,
+    get_catalog_generation,
+    invalidate_catalog_cache,
+    set_catalog_cache,
+)
+from ..database import get_db, get_gridfs_bucket
 
 # Используем orjson если доступен, иначе fallback на стандартный json
 try:
@@ -28,14 +36,17 @@ from ..schemas import (
     CategoryCreate,
     CategoryDetail,
     CategoryUpdate,
+    PRODUCT_LIST_ADAPTER,
     Product,
     ProductCreate,
     ProductUpdate,
+    has_required_fields,
 )
 from ..utils import (
     as_object_id,
     delete_product_images_from_gridfs,
-    get_gridfs,
+    get_gridfs_content_type,
+    iter_gridfs_chunks,
     normalize_product_images,
     save_base64_image_to_gridfs,
     save_base64_images_to_gridfs,
@@ -45,6 +56,29 @@ from ..utils import (
 router = APIRouter(tags=["catalog"])
 logger = logging.getLogger(__name__)
 
+# Поля товара, которые отдаются в API (единая проекция для всех запросов товаров)
+PRODUCT_PROJECTION = {
+    "name": 1,
+    "description": 1,
+    "price": 1,
+    "image": 1,
+    "images": 1,
+    "category_id": 1,
+    "available": 1,
+    "variants": 1,
+    "_id": 1,
+}
+
+# Опции orjson для каталога: в данных нет numpy и нестроковых ключей, поэтому флаги не нужны
+_ORJSON_OPTS = 0
+
+
+def _oid_to_str(value: object) -> str:
+    """Быстрое преобразование _id в строку: bytes.hex() вместо ObjectId.__str__."""
+    if type(value) is ObjectId:
+        return value.binary.hex()
+    return str(value)
+
 
 async def _load_catalog_from_db(db: AsyncIOMotorDatabase, only_available: bool = True) -> CatalogResponse:
     """
@@ -64,17 +98,7 @@ async def _load_catalog_from_db(db: AsyncIOMotorDatabase, only_available: bool =
     products_task = (
         db.products.find(
             products_filter,
-            {
-                "name": 1,
-                "description": 1,
-                "price": 1,
-                "image": 1,
-                "images": 1,
-                "category_id": 1,
-                "available": 1,
-                "variants": 1,
-                "_id": 1,  # Явно включаем _id для консистентности
-            },
+            PRODUCT_PROJECTION,
         )
         # Используем составной индекс и сразу выгружаем в список, чтобы не передавать курсор в gather
         .hint([("category_id", 1), ("available", 1)]).to_list(length=None)
@@ -90,7 +114,7 @@ async def _load_catalog_from_db(db: AsyncIOMotorDatabase, only_available: bool =
         if not name or not isinstance(name, str):
             continue
         # Прямое создание без лишних проверок
-        categories.append(Category(name=name, id=str(doc["_id"])))
+        categories.append(Category(name=name, id=_oid_to_str(doc["_id"])))
 
     # Оптимизированная валидация товаров (минимальные проверки для скорости)
     products = []
@@ -111,10 +135,10 @@ async def _load_catalog_from_db(db: AsyncIOMotorDatabase, only_available: bool =
 
         # Собираем данные товара (минимальная валидация)
         product_data: dict = {
-            "id": str(doc["_id"]),
+            "id": _oid_to_str(doc["_id"]),
             "name": name,
             "price": price,
-            "category_id": str(category_id) if not isinstance(category_id, str) else category_id,
+            "category_id": category_id if isinstance(category_id, str) else _oid_to_str(category_id),
             "available": bool(doc.get("available", True)),
         }
 
@@ -144,13 +168,18 @@ async def _load_catalog_from_db(db: AsyncIOMotorDatabase, only_available: bool =
 
 
 def _catalog_to_dict(payload: CatalogResponse) -> dict:
-    return payload.dict(by_alias=True, exclude_none=False)
+    return payload.model_dump(by_alias=True, exclude_none=False)
 
 
-def _compute_catalog_etag(payload: CatalogResponse) -> str:
-    payload_dict = _catalog_to_dict(payload)
-    serialized = json.dumps(payload_dict, sort_keys=True, ensure_ascii=False)
-    return sha256(serialized.encode("utf-8")).hexdigest()
+def _compute_catalog_etag(body: bytes) -> str:
+    """
+    Считает ETag по уже сериализованному телу каталога.
+
+    Сортировка ключей не нужна: порядок полей задается объявлением моделей
+    CatalogResponse/Category/Product, поэтому сериализация детерминирована.
+    Стабильность ETag зависит от этого порядка.
+    """
+    return sha256(body).hexdigest()
 
 
 def _empty_catalog() -> CatalogResponse:
@@ -162,32 +191,92 @@ async def fetch_catalog(
     db: Optional[AsyncIOMotorDatabase],
     *,
     only_available: bool = True,
-) -> Tuple[CatalogResponse, str]:
-    """Загружает каталог из БД (без кэширования для актуальности данных)."""
+) -> Tuple[bytes, str]:
+    """Загружает каталог из БД (без кеша) и возвращает готовое JSON-тело и его ETag."""
     # Если БД недоступна, возвращаем пустой каталог
     if db is None:
-        return _empty_catalog(), "empty-catalog"
+        return _EMPTY_CATALOG_BODY, "empty-catalog"
 
-    # Загружаем данные напрямую из БД без кэширования
     try:
         data = await _load_catalog_from_db(db, only_available=only_available)
-        etag = _compute_catalog_etag(data)
-        return data, etag
+        # Тело сериализуется один раз: оно же идет в ответ и в хеш ETag
+        body = _render_catalog(data)
+        return body, _compute_catalog_etag(body)
     except Exception as e:
         logger.error(f"Ошибка при загрузке каталога из БД: {e}", exc_info=True)
-        return _empty_catalog(), "error-catalog"
+        return _EMPTY_CATALOG_BODY, "error-catalog"
 
 
-def _build_catalog_response(catalog: CatalogResponse, etag: str) -> Response:
-    """Создает ответ с использованием orjson/json для быстрой сериализации."""
+async def fetch_public_catalog_body(db: Optional[AsyncIOMotorDatabase]) -> Tuple[bytes, str]:
+    """
+    Возвращает готовое JSON-тело публичного каталога и его ETag.
+
+    Тело хранится в in-memory кеше уже сериализованным, поэтому попадание в кеш
+    не требует ни валидации моделей, ни повторной сериализации.
+    """
+    cached = get_catalog_cache()
+    if cached is not None:
+        return cached.body, cached.etag
+    return await _refresh_catalog_cache(db)
+
+
+async def _refresh_catalog_cache(db: Optional[AsyncIOMotorDatabase]) -> Tuple[bytes, str]:
+    """Загружает публичный каталог, сериализует, считает ETag и кладет всё в кеш."""
+    generation = get_catalog_generation()
+    body, etag = await fetch_catalog(db, only_available=True)
+    # Fallback-ответы (БД недоступна/ошибка) не кешируем
+    if etag not in ("empty-catalog", "error-catalog"):
+        set_catalog_cache(body, etag, generation)
+    return body, etag
+
+
+# Фоновая пересборка каталога: одна задача (ссылка хранится, чтобы её не собрал GC)
+# и флаг "нужна ещё одна пересборка" вместо отдельной задачи на каждое изменение.
+_catalog_rebuild_task: Optional[asyncio.Task] = None
+_catalog_rebuild_pending = False
+
+
+async def _catalog_rebuild_worker(db: AsyncIOMotorDatabase) -> None:
+    """Пересобирает каталог, пока поступают новые изменения (серия правок схлопывается)."""
+    global _catalog_rebuild_pending
+    while _catalog_rebuild_pending:
+        _catalog_rebuild_pending = False
+        try:
+            await _refresh_catalog_cache(db)
+        except Exception as e:
+            logger.warning(f"Не удалось пересобрать кеш каталога: {e}")
+
+
+def _invalidate_and_rebuild_catalog(db: AsyncIOMotorDatabase) -> None:
+    """
+    Сбрасывает кеш после изменения каталога админом и сразу пересобирает его в фоне.
+
+    Вся подготовка (модели, сериализация, ETag) выполняется здесь, а не на
+    запросах покупателей: они получают готовые байты из кеша.
+    """
+    global _catalog_rebuild_task, _catalog_rebuild_pending
+    invalidate_catalog_cache()
+    _catalog_rebuild_pending = True
+    if _catalog_rebuild_task is None or _catalog_rebuild_task.done():
+        _catalog_rebuild_task = asyncio.create_task(_catalog_rebuild_worker(db))
+
+
+def _render_catalog(catalog: CatalogResponse) -> bytes:
+    """Сериализует каталог в JSON-байты (orjson если доступен, иначе стандартный json)."""
     catalog_dict = _catalog_to_dict(catalog)
-    # Используем orjson если доступен, иначе стандартный json
     if HAS_ORJSON:
-        content = orjson.dumps(catalog_dict, option=orjson.OPT_SERIALIZE_NUMPY)
-    else:
-        content = json.dumps(catalog_dict).encode("utf-8")
+        return orjson.dumps(catalog_dict, option=_ORJSON_OPTS)
+    return json.dumps(catalog_dict).encode("utf-8")
+
+
+# Тело пустого каталога для fallback-ответов сериализуется один раз при импорте
+_EMPTY_CATALOG_BODY = _render_catalog(_empty_catalog())
+
+
+def _build_catalog_response(body: bytes, etag: str) -> Response:
+    """Создает ответ из уже сериализованного тела каталога."""
     response = Response(
-        content=content,
+        content=body,
         media_type="application/json",
         headers={
             "ETag": etag,
@@ -211,7 +300,7 @@ def _build_cache_control_value() -> str:
 
     Каталог меняется по требованию админа, поэтому клиентам нужно
     всегда перепроверять данные у API, даже если запросы идут подряд.
-    Сервер всё равно держит тёплый кэш в памяти (_catalog_cache), поэтому
+    Сервер всё равно держит тёплый кэш в памяти (app.cache), поэтому
     повторные проверки практически не нагружают базу.
     Используем max-age=0 + must-revalidate, чтобы браузеры не возвращали
     устаревший ответ из собственного HTTP-кэша (причина исчезающих категорий).
@@ -224,24 +313,29 @@ async def get_catalog(
     db: Optional[AsyncIOMotorDatabase] = Depends(get_db),
     if_none_match: str | None = Header(None, alias="If-None-Match"),
 ):
-    """Возвращает каталог товаров (прямой запрос к БД без кэширования для актуальности данных)."""
+    """Возвращает каталог товаров (из in-memory кеша, инвалидируемого при изменениях)."""
+    # Дешёвый 304: при совпадении ETag с тёплым кешем отвечаем без каких-либо await
+    if if_none_match:
+        cached = get_catalog_cache()
+        if cached is not None and cached.etag == if_none_match:
+            return _build_not_modified_response(cached.etag)
+
     try:
-        # Загружаем каталог напрямую из БД без кэширования
-        catalog, etag = await fetch_catalog(db, only_available=True)
+        body, etag = await fetch_public_catalog_body(db)
 
         if if_none_match and if_none_match == etag:
             return _build_not_modified_response(etag)
-        return _build_catalog_response(catalog, etag)
+        return _build_catalog_response(body, etag)
     except HTTPException as e:
         # Если БД недоступна, возвращаем пустой каталог вместо ошибки
         if e.status_code == status.HTTP_503_SERVICE_UNAVAILABLE:
-            return _build_catalog_response(_empty_catalog(), "empty-catalog")
+            return _build_catalog_response(_EMPTY_CATALOG_BODY, "empty-catalog")
         logger.error(f"HTTPException при получении каталога: {e.status_code} - {e.detail}")
         raise
     except Exception as e:
         logger.error(f"Ошибка при получении каталога: {type(e).__name__}: {e}", exc_info=True)
         # Возвращаем пустой каталог вместо 500, чтобы фронтенд не падал
-        return _build_catalog_response(_empty_catalog(), "error-catalog")
+        return _build_catalog_response(_EMPTY_CATALOG_BODY, "error-catalog")
 
 
 @router.get("/admin/catalog", response_model=CatalogResponse)
@@ -254,8 +348,8 @@ async def get_admin_catalog(
     """
     try:
         # Админка загружает все товары, включая недоступные
-        catalog, etag = await fetch_catalog(db, only_available=False)
-        response = _build_catalog_response(catalog, etag)
+        body, etag = await fetch_catalog(db, only_available=False)
+        response = _build_catalog_response(body, etag)
         # Админке всегда нужен свежий ответ, поэтому блокируем клиентский кэш.
         response.headers["Cache-Control"] = "no-store, max-age=0"
         response.headers["Pragma"] = "no-cache"
@@ -289,35 +383,31 @@ async def get_admin_category_detail(
     # Используем проекцию для минимизации загружаемых данных
     products_cursor = db.products.find(
         {"category_id": {"$in": list(candidate_values)}},
-        {
-            "name": 1,
-            "description": 1,
-            "price": 1,
-            "image": 1,
-            "images": 1,
-            "category_id": 1,
-            "available": 1,
-            "variants": 1,
-            "_id": 1,
-        }
+        PRODUCT_PROJECTION
     )
     products_docs = await products_cursor.to_list(length=None)
 
-    serialized_category = serialize_doc(category_doc)
-    serialized_category.pop("_id", None)  # Удаляем _id, так как используем id
-    category_model = Category(**serialized_category | {"id": str(category_doc["_id"])})
+    # Данные из нашей же БД: модели собираем без валидации и сериализуем в pydantic-core
+    category_model = Category.from_mongo(category_doc)
+    # Нормализуем изображения перед сериализацией. Документы без обязательных полей
+    # пропускаем: без валидации они ушли бы в ответ с нарушением схемы Product
     products_models = []
     for doc in products_docs:
-        try:
-            # Нормализуем изображения перед сериализацией
-            normalized_doc = normalize_product_images(doc)
-            serialized = serialize_doc(normalized_doc)
-            serialized.pop("_id", None)  # Удаляем _id, так как используем id
-            products_models.append(Product(**serialized | {"id": str(doc["_id"])}))
-        except Exception:
+        if not has_required_fields(Product, doc):
+            logger.warning(f"Товар {doc.get('_id')} пропущен: нет обязательных полей")
             continue
-
-    return CategoryDetail(category=category_model, products=products_models)
+        products_models.append(Product.from_mongo(normalize_product_images(doc)))
+
+    body = b"".join(
+        (
+            b'{"category":',
+            category_model.model_dump_json(by_alias=True, warnings=False).encode("utf-8"),
+            b',"products":',
+            PRODUCT_LIST_ADAPTER.dump_json(products_models, by_alias=True, warnings=False),
+            b"}",
+        )
+    )
+    return Response(content=body, media_type="application/json")
 
 
 def _build_id_candidates(raw_id: str) -> Sequence[object]:
@@ -350,6 +440,7 @@ async def create_category(
 
     category_data = {"name": payload.name.strip()}
     result = await db.categories.insert_one(category_data)
+    _invalidate_and_rebuild_catalog(db)
     # Используем проекцию для минимизации данных
     doc = await db.categories.find_one({"_id": result.inserted_id}, {"name": 1, "_id": 1})
     if not doc:
@@ -369,39 +460,28 @@ async def update_category(
     _admin_id: int = Depends(verify_admin),
 ):
     """Обновляет категорию."""
-    update_data = payload.dict(exclude_unset=True)
+    update_data = payload.model_dump(exclude_unset=True)
     if not update_data:
         raise HTTPException(status_code=400, detail="Нет данных для обновления")
 
-    category_doc = await db.categories.find_one({"_id": {"$in": _build_id_candidates(category_id)}})
-    if not category_doc:
-        raise HTTPException(status_code=404, detail="Категория не найдена")
-
     if "name" in update_data and update_data["name"] is not None:
         update_data["name"] = update_data["name"].strip()
         if not update_data["name"]:
             raise HTTPException(status_code=400, detail="Название категории не может быть пустым")
 
-        # Проверяем существование с проекцией для минимизации данных
-        existing = await db.categories.find_one(
-            {
-                "name": update_data["name"],
-                "_id": {"$ne": category_doc["_id"]},
-            },
-            {"_id": 1}
+    # Один round-trip: уникальность названия гарантирует unique-индекс categories.name
+    try:
+        result = await db.categories.find_one_and_update(
+            {"_id": {"$in": _build_id_candidates(category_id)}},
+            {"$set": update_data},
+            return_document=ReturnDocument.AFTER,
+            projection={"name": 1, "_id": 1}
         )
-        if existing:
-            raise HTTPException(status_code=400, detail="Категория с таким названием уже существует")
-
-    # Используем проекцию для минимизации данных
-    result = await db.categories.find_one_and_update(
-        {"_id": category_doc["_id"]},
-        {"$set": update_data},
-        return_document=ReturnDocument.AFTER,
-        projection={"name": 1, "_id": 1}
-    )
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Категория с таким названием уже существует")
     if not result:
         raise HTTPException(status_code=404, detail="Категория не найдена")
+    _invalidate_and_rebuild_catalog(db)
     
     serialized = serialize_doc(result)
     serialized.pop("_id", None)  # Удаляем _id, так как используем id
@@ -419,7 +499,11 @@ async def delete_category(
     _admin_id: int = Depends(verify_admin),
 ):
     """Удаляет категорию и все связанные товары с их изображениями из GridFS."""
-    category_doc = await db.categories.find_one({"_id": {"$in": _build_id_candidates(category_id)}})
+    # Поиск и удаление категории одним round-trip
+    category_doc = await db.categories.find_one_and_delete(
+        {"_id": {"$in": _build_id_candidates(category_id)}},
+        projection={"_id": 1},
+    )
     if not category_doc:
         raise HTTPException(status_code=404, detail="Категория не найдена")
 
@@ -429,28 +513,37 @@ async def delete_category(
     }
     if isinstance(category_doc["_id"], ObjectId):
         cleanup_values.add(category_doc["_id"])
+    products_filter = {"category_id": {"$in": list(cleanup_values)}}
 
     # Получаем все товары категории с их изображениями перед удалением
-    products = await db.products.find(
-        {"category_id": {"$in": list(cleanup_values)}},
-        {"image": 1, "images": 1}
-    ).to_list(length=None)
-    
-    # Удаляем изображения всех товаров из GridFS
-    for product_doc in products:
-        await delete_product_images_from_gridfs(product_doc)
-    
-    # Удаляем все товары категории
-    await db.products.delete_many({"category_id": {"$in": list(cleanup_values)}})
+    products = await db.products.find(products_filter, {"image": 1, "images": 1}).to_list(length=None)
 
-    # Удаляем саму категорию
-    delete_result = await db.categories.delete_one({"_id": category_doc["_id"]})
-    if delete_result.deleted_count == 0:
-        raise HTTPException(status_code=404, detail="Категория не найдена")
+    # Удаляем товары и их изображения из GridFS параллельно
+    await asyncio.gather(
+        db.products.delete_many(products_filter),
+        delete_product_images_from_gridfs(db, products),
+    )
+    _invalidate_and_rebuild_catalog(db)
 
     return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 
+def _product_response(doc: dict, status_code: int = status.HTTP_200_OK) -> Response:
+    """
+    Отдает товар, только что записанный в БД, готовым JSON-телом.
+
+    Модель собирается без валидации и сериализуется в pydantic-core; response_model
+    у маршрутов остается только для документации, так как FastAPI не валидирует Response.
+    """
+    # Нормализуем изображения перед сериализацией (на случай если данные уже были в БД)
+    product = Product.from_mongo(normalize_product_images(doc))
+    return Response(
+        content=product.model_dump_json(by_alias=True, warnings=False),
+        media_type="application/json",
+        status_code=status_code,
+    )
+
+
 @router.post(
     "/admin/product",
     response_model=Product,
@@ -467,7 +560,7 @@ async def create_product(
     if not category:
         raise HTTPException(status_code=400, detail="Категория не найдена")
     
-    data = payload.dict()
+    data = payload.model_dump()
     
     # Конвертируем base64 изображения в GridFS file_id
     if data.get("image") and isinstance(data["image"], str) and data["image"].startswith("data:image"):
@@ -491,27 +584,13 @@ async def create_product(
     data = normalize_product_images(data)
     
     result = await db.products.insert_one(data)
+    _invalidate_and_rebuild_catalog(db)
     # Используем проекцию для минимизации загружаемых данных
     doc = await db.products.find_one(
         {"_id": result.inserted_id},
-        {
-            "name": 1,
-            "description": 1,
-            "price": 1,
-            "image": 1,
-            "images": 1,
-            "category_id": 1,
-            "available": 1,
-            "variants": 1,
-            "_id": 1,
-        }
+        PRODUCT_PROJECTION
     )
-    # Нормализуем изображения перед сериализацией (на случай если данные уже были в БД)
-    normalized_doc = normalize_product_images(doc)
-    serialized = serialize_doc(normalized_doc)
-    serialized.pop("_id", None)  # Удаляем _id, так как используем id
-    product = Product(**serialized | {"id": str(doc["_id"])})
-    return product
+    return _product_response(doc, status.HTTP_201_CREATED)
 
 
 @router.patch("/admin/product/{product_id}", response_model=Product)
@@ -522,7 +601,7 @@ async def update_product(
     _admin_id: int = Depends(verify_admin),
 ):
     """Обновляет товар."""
-    update_payload = payload.dict(exclude_unset=True)
+    update_payload = payload.model_dump(exclude_unset=True)
     product_oid = as_object_id(product_id)
     
     # Если меняется категория, проверяем её существование с проекцией
@@ -592,27 +671,13 @@ async def update_product(
         {"_id": product_oid},
         {"$set": update_payload},
         return_document=True,
-        projection={
-            "name": 1,
-            "description": 1,
-            "price": 1,
-            "image": 1,
-            "images": 1,
-            "category_id": 1,
-            "available": 1,
-            "variants": 1,
-            "_id": 1,
-        }
+        projection=PRODUCT_PROJECTION
     )
     if not doc:
         raise HTTPException(status_code=404, detail="Товар не найден")
+    _invalidate_and_rebuild_catalog(db)
     
-    # Нормализуем изображения перед сериализацией
-    normalized_doc = normalize_product_images(doc)
-    serialized = serialize_doc(normalized_doc)
-    serialized.pop("_id", None)  # Удаляем _id, так как используем id
-    product = Product(**serialized | {"id": str(doc["_id"])})
-    return product
+    return _product_response(doc)
 
 
 @router.options("/product/image/{file_id}")
@@ -629,28 +694,49 @@ async def options_product_image(file_id: str):
     )
 
 
+# Кешируем на 1 год, immutable избавляет браузеры и CDN от ревалидации
+_PRODUCT_IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
 @router.get("/product/image/{file_id}")
 async def get_product_image(
     file_id: str,
+    if_none_match: str | None = Header(None, alias="If-None-Match"),
 ):
     """Получает изображение продукта из GridFS по file_id."""
+    # file_id новый для каждого загруженного файла, поэтому изображение неизменяемо:
+    # ETag = file_id, а повторная проверка кеша отвечает 304 без обращения к GridFS
+    etag = f'"{file_id}"'
+    if if_none_match and if_none_match == etag:
+        return Response(
+            status_code=status.HTTP_304_NOT_MODIFIED,
+            headers={
+                "ETag": etag,
+                "Cache-Control": _PRODUCT_IMAGE_CACHE_CONTROL,
+                "Access-Control-Allow-Origin": "*",
+            },
+        )
+
     try:
-        fs = get_gridfs()
-        loop = asyncio.get_event_loop()
+        bucket = await get_gridfs_bucket()
+        if bucket is None:
+            raise HTTPException(status_code=503, detail="База данных недоступна")
 
-        # Получаем файл из GridFS (синхронная операция в executor)
-        grid_file = await loop.run_in_executor(None, lambda: fs.get(ObjectId(file_id)))
-        file_data = await loop.run_in_executor(None, grid_file.read)
+        # Открываем файл через асинхронный GridFS bucket (без executor и sync-клиента)
+        grid_file = await bucket.open_download_stream(ObjectId(file_id))
         filename = grid_file.filename or "product-image"
-        content_type = grid_file.content_type or "image/jpeg"
+        content_type = get_gridfs_content_type(grid_file, "image/jpeg")
 
-        # Создаем Response с CORS заголовками
-        response = Response(
-            content=file_data,
+        # Отдаем файл потоком по чанкам GridFS: память на запрос ограничена размером
+        # чанка, а первый байт уходит клиенту сразу после чтения первого чанка
+        response = StreamingResponse(
+            iter_gridfs_chunks(grid_file),
             media_type=content_type,
             headers={
+                "Content-Length": str(grid_file.length),
                 "Content-Disposition": f'inline; filename="{filename}"',
-                "Cache-Control": "public, max-age=31536000",  # Кешируем на 1 год
+                "Cache-Control": _PRODUCT_IMAGE_CACHE_CONTROL,
+                "ETag": etag,
             },
         )
         
@@ -688,10 +774,11 @@ async def delete_product(
         raise HTTPException(status_code=404, detail="Товар не найден")
     
     # Удаляем изображения из GridFS
-    await delete_product_images_from_gridfs(product_doc)
+    await delete_product_images_from_gridfs(db, [product_doc])
     
     # Удаляем товар из базы данных
     result = await db.products.delete_one({"_id": product_oid})
+    _invalidate_and_rebuild_catalog(db)
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Товар не найден")
     
@@ -2,20 +2,29 @@
 
 import asyncio
 import logging
-from datetime import datetime
+from dataclasses import asdict
 from pathlib import Path
 from uuid import uuid4
 
 from bson import ObjectId
 from fastapi import APIRouter, BackgroundTasks, Depends, File, Form, HTTPException, Response, UploadFile, status
-from motor.motor_asyncio import AsyncIOMotorDatabase
+from motor.motor_asyncio import AsyncIOMotorDatabase, AsyncIOMotorGridFSBucket
 
 from ..config import settings
-from ..database import get_db
+from ..database import get_db, get_gridfs_bucket
 from ..notifications import notify_admins_new_order
 from ..schemas import Cart, Order, OrderStatus
 from ..security import TelegramUser, get_current_user
-from ..utils import as_object_id, compress_image_bytes, ensure_store_is_awake, get_gridfs, serialize_doc, validate_phone_number
+from ..utils import (
+    IMAGE_EXECUTOR,
+    as_object_id,
+    compress_image_bytes,
+    ensure_store_is_awake,
+    serialize_doc,
+    spawn_background_task,
+    utcnow,
+    validate_phone_number,
+)
 
 router = APIRouter(tags=["orders"])
 logger = logging.getLogger(__name__)
@@ -39,6 +48,48 @@ ALLOWED_RECEIPT_MIME_TYPES = {
     "image/heif": ".heif",
 }
 MAX_RECEIPT_SIZE_BYTES = settings.max_receipt_size_mb * 1024 * 1024
+RECEIPT_READ_CHUNK_SIZE = 1024 * 1024  # 1 МБ
+
+
+def _receipt_too_large() -> HTTPException:
+    return HTTPException(
+        status_code=400,
+        detail=f"Файл слишком большой. Максимум {settings.max_receipt_size_mb} МБ",
+    )
+
+
+async def _stream_receipt_to_gridfs(
+    bucket: AsyncIOMotorGridFSBucket,
+    file: UploadFile,
+    filename: str,
+    metadata: dict,
+) -> ObjectId:
+    """Пишет чек в GridFS порциями по мере чтения загрузки; при ошибке файл не сохраняется."""
+    grid_in = bucket.open_upload_stream(filename, metadata=metadata)
+    total_size = 0
+    try:
+        while chunk := await file.read(RECEIPT_READ_CHUNK_SIZE):
+            total_size += len(chunk)
+            if total_size > MAX_RECEIPT_SIZE_BYTES:
+                raise _receipt_too_large()
+            await grid_in.write(chunk)
+        if total_size == 0:
+            raise HTTPException(status_code=400, detail="Файл чека пустой")
+        await grid_in.close()
+    except HTTPException:
+        await grid_in.abort()
+        raise
+    except Exception as e:
+        await grid_in.abort()
+        raise HTTPException(status_code=500, detail=f"Ошибка при сохранении файла в GridFS: {str(e)}")
+    return grid_in._id
+
+
+async def _delete_receipt_file(receipt_file_id: str) -> None:
+    """Удаляет файл чека из GridFS (очистка, если заказ не удалось сохранить)."""
+    bucket = await get_gridfs_bucket()
+    if bucket is not None:
+        await bucket.delete(ObjectId(receipt_file_id))
 
 
 async def _save_payment_receipt(db: AsyncIOMotorDatabase, file: UploadFile) -> tuple[str, str | None]:
@@ -55,75 +106,74 @@ async def _save_payment_receipt(db: AsyncIOMotorDatabase, file: UploadFile) -> t
                 detail="Поддерживаются только изображения (JPG, PNG, WEBP, HEIC) или PDF",
             )
 
-    # Читаем файл правильно, чтобы избежать ошибок с закрытым файлом
-    # Используем асинхронный метод read() который правильно обрабатывает файл
-    try:
-        file_bytes = await file.read()
-    except Exception as e:
-        raise HTTPException(status_code=400, detail=f"Ошибка при чтении файла: {str(e)}")
-
-    if not file_bytes:
-        raise HTTPException(status_code=400, detail="Файл чека пустой")
-    if len(file_bytes) > MAX_RECEIPT_SIZE_BYTES:
-        raise HTTPException(
-            status_code=400,
-            detail=f"Файл слишком большой. Максимум {settings.max_receipt_size_mb} МБ",
-        )
+    # Определяем content_type для GridFS
+    gridfs_content_type = content_type if content_type else "application/octet-stream"
+    original_content_type = gridfs_content_type
 
-    # Сжимаем изображения перед сохранением (PDF не сжимаем)
     is_image = extension in {".jpg", ".jpeg", ".png", ".webp"} or (
         content_type and content_type.startswith("image/") and "pdf" not in content_type
     )
-    if is_image:
-        # Определяем формат для сжатия
-        if extension in {".jpg", ".jpeg"} or "jpeg" in content_type:
-            format = "JPEG"
-        elif extension == ".png" or "png" in content_type:
-            format = "PNG"
-        elif extension == ".webp" or "webp" in content_type:
-            format = "WEBP"
-        else:
-            format = "JPEG"  # По умолчанию
-        
-        # Сжимаем изображение асинхронно в executor
-        try:
-            loop = asyncio.get_event_loop()
-            file_bytes = await loop.run_in_executor(
-                None,
-                compress_image_bytes,
-                file_bytes,
-                1920,  # max_width
-                1920,  # max_height
-                85,    # quality
-                format
-            )
-        except Exception as e:
-            # В случае ошибки сжатия продолжаем с оригинальным файлом
-            logger.warning(f"Не удалось сжать изображение чека: {e}")
 
-    # Сохраняем в GridFS используя синхронный клиент
-    # Выполняем в executor, чтобы не блокировать event loop
-    loop = asyncio.get_event_loop()
-    fs = get_gridfs()
-    filename = f"{uuid4().hex}{extension}"
+    bucket = await get_gridfs_bucket()
+    if bucket is None:
+        raise HTTPException(status_code=503, detail="База данных недоступна")
 
-    # Определяем content_type для GridFS
-    gridfs_content_type = content_type if content_type else "application/octet-stream"
+    metadata = {
+        "contentType": gridfs_content_type,
+        "original_filename": file.filename,
+        "original_content_type": original_content_type,
+        "uploaded_at": utcnow(),
+    }
+
+    if not is_image:
+        # PDF не сжимаем, поэтому пишем его в GridFS потоком, без буфера на весь файл
+        file_id = await _stream_receipt_to_gridfs(bucket, file, f"{uuid4().hex}{extension}", metadata)
+        return str(file_id), file.filename
+
+    # Читаем файл порциями: слишком большой файл отклоняем сразу после превышения
+    # лимита, не загружая его в память целиком
+    buffer = bytearray()
+    try:
+        while chunk := await file.read(RECEIPT_READ_CHUNK_SIZE):
+            buffer += chunk
+            if len(buffer) > MAX_RECEIPT_SIZE_BYTES:
+                raise _receipt_too_large()
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Ошибка при чтении файла: {str(e)}")
 
-    # Сохраняем файл в GridFS (синхронная операция в executor)
+    if not buffer:
+        raise HTTPException(status_code=400, detail="Файл чека пустой")
+    file_bytes = bytes(buffer)
+    del buffer
+
+    # Изображения перекодируем в WEBP: при том же качестве
+    # это ~30% меньше байт в GridFS и при отдаче чека
     try:
-        file_id = await loop.run_in_executor(
-            None,
-            lambda: fs.put(
-                file_bytes,
-                filename=filename,
-                content_type=gridfs_content_type,
-                metadata={
-                    "original_filename": file.filename,
-                    "uploaded_at": datetime.utcnow(),
-                },
-            ),
+        loop = asyncio.get_running_loop()
+        compressed_bytes = await loop.run_in_executor(
+            IMAGE_EXECUTOR,
+            compress_image_bytes,
+            file_bytes,
+            1920,  # max_width
+            1920,  # max_height
+            80,    # quality
+            "WEBP",
         )
+        # compress_image_bytes возвращает исходные байты, если перекодирование
+        # не уменьшило файл или не удалось, тогда тип файла оставляем прежним
+        if compressed_bytes is not file_bytes:
+            file_bytes = compressed_bytes
+            extension = ".webp"
+            metadata["contentType"] = "image/webp"
+    except Exception as e:
+        # В случае ошибки сжатия продолжаем с оригинальным файлом
+        logger.warning(f"Не удалось сжать изображение чека: {e}")
+
+    # Сохраняем в GridFS через асинхронный bucket (без executor и sync-клиента)
+    try:
+        file_id = await bucket.upload_from_stream(f"{uuid4().hex}{extension}", file_bytes, metadata=metadata)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при сохранении файла в GridFS: {str(e)}")
 
@@ -164,13 +214,19 @@ async def create_order(
         # Сохраняем список items с variant_id один раз для переиспользования
         items_with_variants = [item for item in cart.items if item.variant_id]
         if items_with_variants:
-            check_tasks = [
-                db.products.find_one({"_id": as_object_id(item.product_id)}, {"variants": 1})
-                for item in items_with_variants
-            ]
-            products = await asyncio.gather(*check_tasks, return_exceptions=True)
-            for product, item in zip(products, items_with_variants):
-                if isinstance(product, dict):
+            # Один запрос с $in вместо find_one на каждую позицию корзины
+            product_ids = list({as_object_id(item.product_id) for item in items_with_variants})
+            products_by_id = {
+                product["_id"]: product
+                async for product in db.products.find(
+                    {"_id": {"$in": product_ids}},
+                    # Для проверки нужны только id и остаток варианта, без остальных полей
+                    {"variants.id": 1, "variants.quantity": 1},
+                )
+            }
+            for item in items_with_variants:
+                product = products_by_id.get(as_object_id(item.product_id))
+                if product is not None:
                     variant = next((v for v in product.get("variants", []) if v.get("id") == item.variant_id), None)
                     if variant and variant.get("quantity", 0) < 0:
                         raise HTTPException(status_code=400, detail=f"Товар '{item.product_name}' больше не доступен")
@@ -178,8 +234,9 @@ async def create_order(
     receipt_file_id, original_filename = await _save_payment_receipt(db, payment_receipt)
 
     # Преобразуем items один раз для переиспользования
-    items_dict = [item.dict() for item in cart.items]
+    items_dict = [asdict(item) for item in cart.items]
 
+    now = utcnow()
     order_doc = {
         "user_id": user_id,
         "customer_name": name,
@@ -190,8 +247,8 @@ async def create_order(
         "items": items_dict,
         "total_amount": cart.total_amount,
         "can_edit_address": False,  # Адрес нельзя редактировать после создания
-        "created_at": datetime.utcnow(),
-        "updated_at": datetime.utcnow(),
+        "created_at": now,
+        "updated_at": now,
         "payment_receipt_file_id": receipt_file_id,  # ID файла в GridFS
         "payment_receipt_filename": original_filename,
         "delivery_type": delivery_type,
@@ -201,14 +258,10 @@ async def create_order(
     try:
         result = await db.orders.insert_one(order_doc)
     except Exception:
-        # Удаляем файл из GridFS при ошибке (fire-and-forget с логированием ошибок)
+        # Удаляем файл из GridFS при ошибке. BackgroundTasks после исключения не выполняются,
+        # поэтому задача fire-and-forget (ссылка хранится, ошибка логируется)
         try:
-            cleanup_task = asyncio.create_task(
-                asyncio.get_event_loop().run_in_executor(None, lambda: get_gridfs().delete(ObjectId(receipt_file_id)))
-            )
-            cleanup_task.add_done_callback(
-                lambda t: logger.error(f"GridFS cleanup failed: {t.exception()}") if t.exception() else None
-            )
+            spawn_background_task(_delete_receipt_file(receipt_file_id), f"очистка чека {receipt_file_id} в GridFS")
         except Exception as cleanup_exc:
             logger.error(f"Не удалось запланировать очистку GridFS для receipt_file_id={receipt_file_id}: {cleanup_exc}")
         raise
@@ -216,7 +269,7 @@ async def create_order(
     # Добавляем _id к order_doc для создания ответа без дополнительного запроса к БД
     order_doc["_id"] = result.inserted_id
     
-    # Удаляем корзину в фоне (не ждем завершения для ускорения ответа)
+    # Удаляем корзину в фоне после отправки ответа (не ждем завершения для ускорения ответа)
     async def delete_cart_background():
         try:
             await db.carts.delete_one({"_id": as_object_id(cart.id)})
@@ -225,10 +278,7 @@ async def create_order(
                 f"Не удалось удалить корзину {cart.id} после создания заказа {result.inserted_id}: {cart_del_exc}"
             )
 
-    cart_delete_task = asyncio.create_task(delete_cart_background())
-    cart_delete_task.add_done_callback(
-        lambda t: logger.error(f"Cart delete task failed: {t.exception()}") if t.exception() else None
-    )
+    background_tasks.add_task(delete_cart_background)
     
     # Создаем объект Order из order_doc без дополнительного запроса к БД
     order = Order(**serialize_doc(order_doc) | {"id": str(result.inserted_id)})
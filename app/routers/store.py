@@ -1,197 +1,318 @@
 """Модуль для работы со статусом магазина."""
 
-from datetime import datetime, timedelta
-from typing import Optional
-
-from fastapi import APIRouter, Depends, HTTPException, Request, status
+import asyncio
+import json
+import logging
+import time
+from types import MappingProxyType
+from typing import Mapping, NamedTuple, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response, status
 from fastapi.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from pymongo import ReturnDocument
+from pymongo import ReturnDocument, WriteConcern
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
 
 from ..auth import verify_admin
 from ..database import get_db
 from ..schemas import StoreSleepRequest, StoreStatus
+from ..utils import utcnow
+
+# Используем orjson если доступен, иначе fallback на стандартный json
+try:
+    import orjson
+
+    HAS_ORJSON = True
+except ImportError:
+    HAS_ORJSON = False
 
 router = APIRouter(tags=["store"])
+logger = logging.getLogger(__name__)
 
-# Простое in-memory кеширование для статуса магазина
-_cache: Optional[dict] = None
-_cache_expires_at: Optional[datetime] = None
-_cache_ttl_seconds = 60  # Синхронизировано с HTTP Cache-Control max-age=60
 
+class _StoreStatusCacheEntry(NamedTuple):
+    """Запись кеша статуса: документ из БД и уже готовое JSON-тело ответа /store/status."""
 
-async def get_or_create_store_status(db: Optional[AsyncIOMotorDatabase], use_cache: bool = True):
+    doc: Mapping  # неизменяемое представление (MappingProxyType), отдается без копирования
+    body: bytes
+    expires_at: float  # дедлайн по time.monotonic()
+    loaded_at: float  # момент записи по time.monotonic()
+    from_db: bool  # False - fallback, сохраненный при ошибке БД
+
+
+# Простое in-memory кеширование для статуса магазина
+_cache: Optional[_StoreStatusCacheEntry] = None
+_cache_ttl_seconds = 60  # Синхронизировано с HTTP Cache-Control max-age=60
+# HTTP-кеш статуса: max-age совпадает с TTL серверного кеша, а stale-while-revalidate
+# позволяет браузеру/CDN отдавать прошлый ответ, пока в фоне идет перепроверка
+STORE_STATUS_CACHE_CONTROL = f"public, max-age={_cache_ttl_seconds}, stale-while-revalidate={_cache_ttl_seconds}"
+# После истечения TTL еще столько секунд отдаем устаревший статус сразу,
+# а обновление из БД идет в фоне (stale-while-revalidate)
+_cache_stale_grace_seconds = 60
+# Записи статуса некритичны (флаг сна и текст, кеш обновляется сразу): подтверждения
+# primary достаточно, ожидание записи журнала на диск только добавляет задержку
+_FAST_WRITE_CONCERN = WriteConcern(w=1, j=False)
+# Статус по умолчанию, если БД недоступна или документа еще нет
+_FALLBACK_STATUS = {"is_sleep_mode": False, "sleep_message": None}
+# Текущая загрузка статуса из БД (single-flight при промахе кеша)
+_inflight: Optional[asyncio.Task] = None
+# Проверка режима сна перед заказом допускает статус не старше стольких секунд
+_ORDER_GATE_MAX_AGE_SECONDS = 5
+# Перечитывание статуса для проверки перед заказом: при истечении окна в БД идет
+# один запрос, остальные заказы ждут его под блокировкой
+_order_gate_lock = asyncio.Lock()
+# Поколение кеша: загрузка, начатая до переключения режима сна, не должна записать устаревший статус
+_cache_generation = 0
+
+
+async def get_or_create_store_status(db: Optional[AsyncIOMotorDatabase], use_cache: bool = True) -> Mapping:
     """
     Получает или создает статус магазина с опциональным кешированием.
     Использует локальное in-memory кеширование для снижения числа чтений из MongoDB.
 
+    Из кеша возвращается неизменяемое представление документа (без копии на каждый запрос),
+    поэтому результат нельзя изменять.
+
     Args:
         db: Подключение к БД (может быть None если БД недоступна)
         use_cache: Использовать ли кеш (по умолчанию True)
     """
-    global _cache, _cache_expires_at
-
     # Если БД недоступна, возвращаем fallback из кеша или дефолтные значения
     if db is None:
         if use_cache:
             if _cache is not None:
-                return _cache.copy()
-        return {
-            "is_sleep_mode": False,
-            "sleep_message": None,
-            "updated_at": datetime.utcnow(),
-        }
-
-    # Проверяем кеш, если он включен
-    if use_cache:
-        if _cache is not None and _cache_expires_at is not None:
-            if datetime.utcnow() < _cache_expires_at:
-                return _cache.copy()
+                return _cache.doc
+        return _make_fallback_status()
+
+    if not use_cache:
+        return await _load_store_status(db, use_cache=False)
+
+    # Свежий или допустимо устаревший кеш (во втором случае обновление уже запущено в фоне)
+    entry = _get_cache_or_revalidate(db)
+    if entry is not None:
+        return entry.doc
+
+    # Кеша нет совсем: ждем загрузку из БД
+    # shield: отмена одного ожидающего запроса не должна отменять общую загрузку
+    return await asyncio.shield(_start_refresh(db))
+
+
+def _get_cache_or_revalidate(db: AsyncIOMotorDatabase) -> Optional[_StoreStatusCacheEntry]:
+    """
+    Возвращает запись кеша без ожидания БД (stale-while-revalidate).
+
+    Свежая запись отдается как есть. Истекшая, но не старше grace-периода, тоже
+    отдается сразу, а обновление запускается в фоне. Иначе возвращает None.
+    """
+    entry = _cache
+    if entry is None:
+        return None
+    now = time.monotonic()
+    if now < entry.expires_at:
+        return entry
+    if now < entry.expires_at + _cache_stale_grace_seconds:
+        _start_refresh(db)
+        return entry
+    return None
+
+
+def _start_refresh(db: AsyncIOMotorDatabase) -> asyncio.Task:
+    """
+    Запускает загрузку статуса из БД в кеш, если она еще не идет.
+
+    Single-flight: при промахе кеша в БД идет только один запрос,
+    остальные конкурентные запросы ждут его результат.
+    """
+    global _inflight
+    if _inflight is None:
+        _inflight = asyncio.create_task(_load_store_status(db, use_cache=True, generation=_cache_generation))
+        _inflight.add_done_callback(_clear_inflight)
+    return _inflight
+
 
+def _clear_inflight(task: asyncio.Task) -> None:
+    global _inflight
+    if _inflight is task:
+        _inflight = None
+
+
+async def _load_store_status(
+    db: AsyncIOMotorDatabase, use_cache: bool, generation: Optional[int] = None
+) -> dict:
+    """
+    Загружает (или создает) статус магазина из БД и обновляет кеш.
+
+    generation - поколение кеша, снятое до чтения из БД: если статус успели переключить,
+    результат в кеш не пишется.
+    """
+    from_db = True
     try:
-        # Используем projection для оптимизации - загружаем только нужные поля
-        doc = await db.store_status.find_one(
-            {},
-            {
-                "is_sleep_mode": 1,
-                "sleep_message": 1,
-                "updated_at": 1,
-            },
-        )
-        if not doc:
-            status_doc = {
-                "is_sleep_mode": False,
-                "sleep_message": None,
-                "updated_at": datetime.utcnow(),
-            }
-            result = await db.store_status.insert_one(status_doc)
-            status_doc["_id"] = result.inserted_id
-            # Обновляем локальный кеш
-            if use_cache:
-                _update_cache(status_doc)
-            return status_doc
-        
-        # Очищаем старые неиспользуемые поля при чтении (если они есть)
-        if "sleep_until" in doc:
-            await db.store_status.update_one(
-                {"_id": doc["_id"]},
-                {
-                    "$unset": {
-                        "sleep_until": "",
-                    }
-                }
-            )
-            # Удаляем поле из документа в памяти
-            doc.pop("sleep_until", None)
-
-        # Обновляем локальный кеш
-        if use_cache:
-            _update_cache(doc)
+        doc = await _fetch_store_status(db)
+    except Exception as e:
+        # Недоступность БД ожидаема, остальные ошибки логируем
+        if not isinstance(e, (ServerSelectionTimeoutError, ConnectionFailure)):
+            logger.error(f"Неожиданная ошибка при получении статуса магазина: {e}", exc_info=True)
+        # Возвращаем fallback вместо исключения
+        doc = _make_fallback_status()
+        from_db = False
+
+    # Обновляем локальный кеш
+    if use_cache:
+        _update_cache(doc, generation, from_db=from_db)
+    return doc
+
+
+async def _fetch_store_status(db: AsyncIOMotorDatabase) -> dict:
+    """Читает (или создает) статус магазина из БД. Ошибки БД пробрасываются."""
+    # Используем projection для оптимизации - загружаем только нужные поля
+    doc = await db.store_status.find_one(
+        {},
+        {
+            "is_sleep_mode": 1,
+            "sleep_message": 1,
+            "updated_at": 1,
+        },
+    )
+    if not doc:
+        doc = _make_fallback_status()
+        result = await db.store_status.insert_one(doc)
+        doc["_id"] = result.inserted_id
+    return doc
+
+
+async def get_store_status_for_order(db: AsyncIOMotorDatabase) -> Mapping:
+    """
+    Возвращает статус магазина для проверки режима сна перед оформлением заказа.
 
+    В отличие от get_or_create_store_status, не отдает fallback "магазин открыт":
+    кеш используется, только если статус прочитан из БД не дольше
+    _ORDER_GATE_MAX_AGE_SECONDS назад, иначе статус читается заново,
+    а ошибка БД пробрасывается вызывающему коду. Перечитывание идет под блокировкой,
+    чтобы конкурентные заказы не обращались к БД каждый сам.
+    """
+    entry = _get_order_gate_entry()
+    if entry is not None:
+        return entry.doc
+    async with _order_gate_lock:
+        # Пока ждали блокировку, статус мог перечитать другой заказ
+        entry = _get_order_gate_entry()
+        if entry is not None:
+            return entry.doc
+        generation = _cache_generation
+        doc = await _fetch_store_status(db)
+        _update_cache(doc, generation)
         return doc
-    except (ServerSelectionTimeoutError, ConnectionFailure) as e:
-        import logging
 
-        # Возвращаем fallback вместо исключения
-        fallback = {
-            "is_sleep_mode": False,
-            "sleep_message": None,
-            "updated_at": datetime.utcnow(),
-        }
-        if use_cache:
-            _update_cache(fallback)
-        return fallback
-    except Exception as e:
-        import logging
 
-        logger = logging.getLogger(__name__)
-        logger.error(f"Неожиданная ошибка при получении статуса магазина: {e}", exc_info=True)
-        # Возвращаем fallback вместо исключения
-        fallback = {
-            "is_sleep_mode": False,
-            "sleep_message": None,
-            "updated_at": datetime.utcnow(),
-        }
-        if use_cache:
-            _update_cache(fallback)
-        return fallback
+def _get_order_gate_entry() -> Optional[_StoreStatusCacheEntry]:
+    """Возвращает запись кеша, прочитанную из БД не дольше _ORDER_GATE_MAX_AGE_SECONDS назад."""
+    entry = _cache
+    if entry is not None and entry.from_db and time.monotonic() - entry.loaded_at < _ORDER_GATE_MAX_AGE_SECONDS:
+        return entry
+    return None
 
 
-def _update_cache(doc: dict):
-    """Обновляет локальный кеш статуса магазина."""
-    global _cache, _cache_expires_at
-    
-    # Обновляем in-memory кэш
-    _cache = doc.copy()
-    _cache_expires_at = datetime.utcnow() + timedelta(seconds=_cache_ttl_seconds)
+def _make_fallback_status() -> dict:
+    """Возвращает статус магазина по умолчанию (магазин открыт)."""
+    return {**_FALLBACK_STATUS, "updated_at": utcnow()}
 
 
-def _invalidate_cache():
-    """Инвалидирует локальный кеш статуса магазина."""
-    global _cache, _cache_expires_at
-    _cache = None
-    _cache_expires_at = None
+async def cleanup_legacy_store_status_fields(db: Optional[AsyncIOMotorDatabase]) -> None:
+    """
+    Удаляет устаревшие поля (sleep_until, payment_link) из статуса магазина.
+
+    Выполняется один раз при старте приложения, чтобы путь чтения статуса
+    оставался только чтением.
+    """
+    if db is None:
+        return
+    collection = db.get_collection("store_status", write_concern=_FAST_WRITE_CONCERN)
+    await collection.update_many(
+        {"$or": [{"sleep_until": {"$exists": True}}, {"payment_link": {"$exists": True}}]},
+        {"$unset": {"sleep_until": "", "payment_link": ""}},
+    )
 
 
-def _normalize_store_status_doc(doc: dict) -> dict:
+def _update_cache(doc: dict, generation: Optional[int] = None, from_db: bool = True):
     """
-    Нормализует документ из БД для создания StoreStatus модели.
+    Обновляет локальный кеш статуса магазина (вместе с готовым телом ответа).
 
-    Преобразует типы полей и удаляет лишние поля.
+    Если передано generation и с момента его снятия кеш сменил поколение, запись отбрасывается.
     """
-    import logging
+    global _cache
+    if generation is not None and generation != _cache_generation:
+        return
+
+    # Тело ответа считаем один раз при записи в кеш, а не на каждом опросе
+    body = _render_store_status(StoreStatus.model_validate(doc).model_dump())
+    now = time.monotonic()
+    _cache = _StoreStatusCacheEntry(
+        # Копия отвязывает кеш от вызывающего кода, proxy запрещает изменять ее снаружи
+        MappingProxyType(doc.copy()),
+        body,
+        now + _cache_ttl_seconds,
+        now,
+        from_db,
+    )
 
-    logger = logging.getLogger(__name__)
 
-    try:
-        normalized = {
-            "is_sleep_mode": bool(doc.get("is_sleep_mode", False)),
-            "sleep_message": doc.get("sleep_message") if doc.get("sleep_message") else None,
-        }
-        # sleep_until убран, т.к. не используется
-        # updated_at убран из ответа API, т.к. не используется на фронтенде
-        # но остается в БД для внутренних нужд
-
-        return normalized
-    except Exception as e:
-        logger.error(f"Ошибка при нормализации документа: {e}, doc: {doc}", exc_info=True)
-        # Возвращаем безопасные значения по умолчанию
-        return {
-            "is_sleep_mode": False,
-            "sleep_message": None,
-        }
+async def warm_store_status_cache(db: Optional[AsyncIOMotorDatabase]) -> None:
+    """Заполняет кеш статуса при старте, чтобы первый запрос не ждал MongoDB."""
+    if db is None:
+        return
+    await get_or_create_store_status(db)
 
 
 @router.get("/store/status", response_model=StoreStatus)
 async def get_store_status(db: Optional[AsyncIOMotorDatabase] = Depends(get_db)):
     """Получает статус магазина."""
-    import logging
-    from typing import Optional
-    from ..config import settings
-
-    logger = logging.getLogger(__name__)
-
     # Если БД недоступна, сразу возвращаем fallback
     if db is None:
-        return StoreStatus(
-            is_sleep_mode=False,
-            sleep_message=None,
-        )
+        return _store_status_response(_FALLBACK_STATUS_BODY)
+
+    # Быстрый путь: готовое тело из кеша, без нормализации и сериализации
+    entry = _get_cache_or_revalidate(db)
+    if entry is not None:
+        return _store_status_response(entry.body)
 
     try:
         # Убрали debug логи для производительности - они замедляют ответ
         doc = await get_or_create_store_status(db)
-        normalized_doc = _normalize_store_status_doc(doc)
-        result = StoreStatus(**normalized_doc)
-        return result
+        return _build_store_status_response(StoreStatus.model_validate(doc).model_dump())
     except Exception as e:
         logger.error(f"Ошибка при получении статуса магазина: {type(e).__name__}: {e}", exc_info=True)
         # Возвращаем fallback вместо 500, чтобы фронтенд не падал
-        return StoreStatus(
-            is_sleep_mode=False,
-            sleep_message=None,
-        )
+        return _store_status_response(_FALLBACK_STATUS_BODY)
+
+
+def _render_store_status(data: dict) -> bytes:
+    """
+    Сериализует статус магазина в JSON через orjson (если доступен).
+
+    Данные уже прошли StoreStatus, поэтому повторная валидация
+    и jsonable_encoder не нужны.
+    """
+    if HAS_ORJSON:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False).encode("utf-8")
+
+
+# Тело fallback-ответа неизменно, поэтому сериализуем его один раз при импорте
+_FALLBACK_STATUS_BODY = _render_store_status(_FALLBACK_STATUS)
+
+
+def _build_store_status_response(data: dict) -> Response:
+    """Создает JSON-ответ статуса магазина из нормализованного словаря."""
+    return _store_status_response(_render_store_status(data))
+
+
+def _store_status_response(content: bytes) -> Response:
+    """Создает JSON-ответ статуса магазина из готового тела."""
+    return Response(
+        content=content,
+        media_type="application/json",
+        headers={"Cache-Control": STORE_STATUS_CACHE_CONTROL},
+    )
 
 
 @router.patch("/admin/store/sleep", response_model=StoreStatus)
@@ -201,14 +322,16 @@ async def toggle_store_sleep(
     _admin_id: int = Depends(verify_admin),
 ):
     """Переключает режим сна магазина."""
+    global _cache_generation
     # Atomic upsert to avoid lost updates from concurrent admin toggles.
-    updated = await db.store_status.find_one_and_update(
+    collection = db.get_collection("store_status", write_concern=_FAST_WRITE_CONCERN)
+    updated = await collection.find_one_and_update(
         {},
         {
             "$set": {
                 "is_sleep_mode": payload.sleep,
                 "sleep_message": payload.message,
-                "updated_at": datetime.utcnow(),
+                "updated_at": utcnow(),
             },
             "$unset": {
                 "sleep_until": "",   # Удаляем старое поле, если оно есть
@@ -216,16 +339,14 @@ async def toggle_store_sleep(
         },
         upsert=True,
         return_document=ReturnDocument.AFTER,
+        projection={"is_sleep_mode": 1, "sleep_message": 1, "updated_at": 1},
     )
-    normalized_doc = _normalize_store_status_doc(updated)
-    status_model = StoreStatus(**normalized_doc)
-    _invalidate_cache()  # Инвалидируем кеш после изменения
+    # Обновленный документ уже на руках: кладем его в кеш вместо инвалидации,
+    # чтобы следующий запрос статуса не ходил в БД. Смена поколения отбрасывает
+    # фоновые загрузки, прочитавшие статус до переключения
+    _cache_generation += 1
+    _update_cache(updated)
     # Broadcaster removed - frontend uses polling instead of SSE
-    return status_model
-
-
-def _serialize_store_status(model: StoreStatus) -> dict:
-    return {
-        "is_sleep_mode": model.is_sleep_mode,
-        "sleep_message": model.sleep_message,
-    }
+    # Отдаем то же тело, что отрендерено (orjson) для кеша: без повторной
+    # валидации и кодирования ответа; ответ админки не кешируется
+    return Response(content=_cache.body, media_type="application/json")
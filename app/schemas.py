@@ -2,14 +2,19 @@
 
 from __future__ import annotations
 
-from datetime import datetime, timezone
+import sys
+from functools import lru_cache
+from datetime import datetime
 from enum import Enum
-from typing import List, Optional
+from typing import List, Literal, Mapping, Optional
 
 from bson import ObjectId
-from pydantic import AnyHttpUrl, BaseModel, Field
+from pydantic import AnyHttpUrl, BaseModel, ConfigDict, Field, TypeAdapter, field_validator
+from pydantic.dataclasses import dataclass
 from pydantic_core import core_schema
 
+from .utils import is_object_id_str, serialize_doc, utcnow
+
 
 class PyObjectId(str):
     """PyObjectId модель для Pydantic v2."""
@@ -24,7 +29,7 @@ class PyObjectId(str):
             if isinstance(v, ObjectId):
                 return str(v)
             if isinstance(v, str):
-                if ObjectId.is_valid(v):
+                if is_object_id_str(v):
                     return v
                 raise ValueError(f"Invalid ObjectId: {v}")
             raise ValueError(f"Invalid ObjectId type: {type(v)}")
@@ -50,6 +55,38 @@ class PyObjectId(str):
         )
 
 
+class MongoDocumentMixin:
+    """Построение модели из документа MongoDB без повторной валидации."""
+
+    @classmethod
+    def from_mongo(cls, doc: dict):
+        """
+        Создает модель из документа нашей же БД через model_construct.
+
+        Данные уже валидировались при записи, поэтому валидаторы не запускаются:
+        ObjectId приводятся к строкам, _id переименовывается в id.
+        """
+        data = serialize_doc(doc)
+        if "_id" in data:
+            data["id"] = data.pop("_id")
+        return cls.model_construct(**data)
+
+
+@lru_cache(maxsize=None)
+def _required_field_names(model: type[BaseModel]) -> tuple[str, ...]:
+    return tuple(field.alias or name for name, field in model.model_fields.items() if field.is_required())
+
+
+def has_required_fields(model: type[BaseModel], doc: Mapping) -> bool:
+    """
+    Проверяет, что в документе есть все обязательные поля модели (и они не null).
+
+    Для документов, которые отдаются без валидации (from_mongo, готовый JSON):
+    старые записи без обязательных полей нарушили бы схему ответа API.
+    """
+    return all(doc.get(name) is not None for name in _required_field_names(model))
+
+
 class CategoryBase(BaseModel):
     """CategoryBase модель."""
 
@@ -68,16 +105,13 @@ class CategoryUpdate(BaseModel):
     name: Optional[str] = Field(None, min_length=1, max_length=64)
 
 
-class Category(CategoryBase):
+class Category(MongoDocumentMixin, CategoryBase):
     """Category модель."""
 
     id: PyObjectId = Field(default_factory=PyObjectId, alias="id")
 
-    class Config:
-        """Конфигурация Pydantic."""
-
-        populate_by_name = True
-        extra = "allow"  # Разрешаем дополнительные поля из базы данных
+    # Разрешаем дополнительные поля из базы данных
+    model_config = ConfigDict(populate_by_name=True, extra="allow")
 
 
 class ProductBase(BaseModel):
@@ -111,17 +145,14 @@ class ProductUpdate(BaseModel):
     variants: Optional[List[dict]] = None
 
 
-class Product(ProductBase):
+class Product(MongoDocumentMixin, ProductBase):
     """Product модель."""
 
     id: PyObjectId = Field(default_factory=PyObjectId, alias="id")
     variants: Optional[List[dict]] = None
 
-    class Config:
-        """Конфигурация Pydantic."""
-
-        populate_by_name = True
-        extra = "allow"  # Разрешаем дополнительные поля из базы данных
+    # Разрешаем дополнительные поля из базы данных
+    model_config = ConfigDict(populate_by_name=True, extra="allow")
 
 
 class CatalogResponse(BaseModel):
@@ -131,7 +162,10 @@ class CatalogResponse(BaseModel):
     products: List[Product]
 
 
-class CartItem(BaseModel):
+# Позиции корзины и заказа создаются списками на каждый запрос, поэтому это
+# slots-датаклассы (как TelegramUser в security.py): без __dict__ на каждый экземпляр
+@dataclass(slots=True, frozen=True, kw_only=True)
+class CartItem:
     """CartItem модель."""
 
     id: str
@@ -152,10 +186,7 @@ class Cart(BaseModel):
     items: List[CartItem] = Field(default_factory=list)
     total_amount: float = 0.0
 
-    class Config:
-        """Конфигурация Pydantic."""
-
-        populate_by_name = True
+    model_config = ConfigDict(populate_by_name=True)
 
 
 class AddToCartRequest(BaseModel):
@@ -182,12 +213,20 @@ class UpdateCartItemRequest(BaseModel):
 class OrderStatus(str, Enum):
     """OrderStatus модель."""
 
-    NEW = "новый"
-    ACCEPTED = "принят"
-    REJECTED = "отказано"
+    # Кириллические литералы не интернируются автоматически; интернированные значения
+    # сравниваются по ссылке, без побайтового сравнения строк
+    NEW = sys.intern("новый")
+    ACCEPTED = sys.intern("принят")
+    REJECTED = sys.intern("отказано")
+
 
+# Те же значения статуса для валидации входящих запросов: pydantic-core проверяет
+# Literal специализированным валидатором, быстрее чем членство в Enum
+OrderStatusLiteral = Literal["новый", "принят", "отказано"]
 
-class OrderItem(BaseModel):
+
+@dataclass(slots=True, frozen=True, kw_only=True)
+class OrderItem:
     """OrderItem модель."""
 
     id: Optional[str] = None  # ID элемента корзины (для совместимости)
@@ -213,8 +252,8 @@ class Order(BaseModel):
     rejection_reason: Optional[str] = None  # Причина отказа (если статус "отказано")
     items: List[OrderItem]
     total_amount: float
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
-    updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+    created_at: datetime = Field(default_factory=utcnow)
+    updated_at: datetime = Field(default_factory=utcnow)
     can_edit_address: bool = True
     payment_receipt_file_id: Optional[str] = None  # ID файла в GridFS
     payment_receipt_url: Optional[str] = None  # Устаревшее поле, оставлено для обратной совместимости
@@ -222,11 +261,8 @@ class Order(BaseModel):
     delivery_type: Optional[str] = None
     payment_type: Optional[str] = None
 
-    class Config:
-        """Конфигурация Pydantic."""
-
-        populate_by_name = True
-        extra = "allow"  # Разрешаем дополнительные поля из базы данных
+    # Разрешаем дополнительные поля из базы данных
+    model_config = ConfigDict(populate_by_name=True, extra="allow")
 
 
 class CreateOrderRequest(BaseModel):
@@ -247,7 +283,7 @@ class UpdateAddressRequest(BaseModel):
 class UpdateStatusRequest(BaseModel):
     """UpdateStatusRequest модель."""
 
-    status: OrderStatus
+    status: OrderStatusLiteral
     rejection_reason: Optional[str] = None  # Причина отказа (обязательна для статуса "отказано")
 
 
@@ -270,11 +306,27 @@ class BroadcastResponse(BaseModel):
 
 
 class StoreStatus(BaseModel):
-    """StoreStatus модель."""
+    """
+    StoreStatus модель.
+
+    Строится прямо из документа store_status: лишние поля (_id, updated_at,
+    устаревшие sleep_until/payment_link) отбрасываются, значения приводятся валидаторами.
+    """
 
     is_sleep_mode: bool = False
     sleep_message: Optional[str] = None
 
+    @field_validator("is_sleep_mode", mode="before")
+    @classmethod
+    def _coerce_sleep_mode(cls, value):
+        # В старых документах флаг может быть None или отсутствовать
+        return bool(value)
+
+    @field_validator("sleep_message", mode="before")
+    @classmethod
+    def _empty_message_to_none(cls, value):
+        return value or None
+
 
 class StoreSleepRequest(BaseModel):
     """StoreSleepRequest модель."""
@@ -295,14 +347,10 @@ class OrderSummary(BaseModel):
     delivery_address: str = Field(..., min_length=1, max_length=500)
     status: OrderStatus = OrderStatus.ACCEPTED
     total_amount: float
-    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+    created_at: datetime = Field(default_factory=utcnow)
     items_count: int = Field(..., description="Количество товаров в заказе")
 
-    class Config:
-        """Конфигурация Pydantic."""
-
-        populate_by_name = True
-        extra = "allow"
+    model_config = ConfigDict(populate_by_name=True, extra="allow")
 
 
 class PaginatedOrdersResponse(BaseModel):
@@ -324,10 +372,12 @@ class Customer(BaseModel):
 
     id: PyObjectId = Field(default_factory=PyObjectId, alias="id")
     telegram_id: int
-    added_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
-    last_cart_activity: datetime = Field(default_factory=lambda: datetime.now(timezone.utc).replace(tzinfo=None))
+    added_at: datetime = Field(default_factory=utcnow)
+    last_cart_activity: datetime = Field(default_factory=utcnow)
+
+    model_config = ConfigDict(populate_by_name=True)
 
-    class Config:
-        """Конфигурация Pydantic."""
 
-        populate_by_name = True
\ No newline at end of file
+# Готовый адаптер для списка товаров: схема сериализации собирается один раз при импорте,
+# а dump_json отдает JSON-байты напрямую из pydantic-core
+PRODUCT_LIST_ADAPTER = TypeAdapter(List[Product])
@@ -1,73 +1,125 @@
 """Утилиты для работы с базой данных и общих операций."""
 
+import asyncio
 import base64
+import functools
 import io
 import logging
+import os
 import re
+import struct
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime, timezone
-from typing import List, Optional
+from typing import AsyncIterator, List, Optional
+from uuid import uuid4
 
 from bson import ObjectId
-from gridfs import GridFS
+from fastapi import HTTPException, status
 from motor.motor_asyncio import AsyncIOMotorDatabase
-from PIL import Image
-from pymongo import MongoClient, ReturnDocument
+from pymongo import ReturnDocument, UpdateOne, WriteConcern
+from pymongo.errors import PyMongoError
 
-from .config import settings
+from .cache import invalidate_catalog_cache
+from .database import get_gridfs_bucket
+
+# pybase64 (SIMD-декодер base64) используем если доступен, иначе стандартный base64
+try:
+    import pybase64
+
+    HAS_PYBASE64 = True
+except ImportError:
+    HAS_PYBASE64 = False
 
 logger = logging.getLogger(__name__)
 
-# Глобальный синхронный клиент MongoDB для GridFS
-_sync_client: MongoClient | None = None
-_gridfs: GridFS | None = None
 
+# libvips (pyvips) используем если доступен: libjpeg-turbo и потоковая обработка
+# дают заметно меньше CPU и памяти на больших фото, иначе fallback на Pillow.
+# Импортируем лениво, при первом сжатии: загрузка libvips и glib добавляет процессу
+# десятки МБ, а utils импортируется каждым роутером, хотя изображения нужны редко
+@functools.lru_cache(maxsize=None)
+def _get_pyvips():
+    try:
+        import pyvips
+    except (ImportError, OSError):
+        return None
+    return pyvips
+
+
+# Отдельный пул потоков для сжатия изображений (CPU), чтобы оно не занимало default executor.
+# Операции GridFS идут через асинхронный bucket на общем пуле Motor и executor не требуют.
+IMAGE_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="image")
+# Пул процессов для пакетного декодирования base64 и сжатия изображений товаров:
+# base64 и часть работы Pillow держат GIL, поэтому потоки не масштабируются по ядрам.
+# Создается лениво, чтобы не поднимать процессы, пока изображения не загружают.
+_image_process_pool: ProcessPoolExecutor | None = None
+
+
+def get_image_process_pool() -> ProcessPoolExecutor:
+    """Возвращает пул процессов для сжатия изображений (размер = число ядер)."""
+    global _image_process_pool
+    if _image_process_pool is None:
+        _image_process_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+    return _image_process_pool
+
+
+def shutdown_executors() -> None:
+    """Останавливает пулы потоков и процессов для изображений (при остановке приложения)."""
+    global _image_process_pool
+    IMAGE_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    if _image_process_pool is not None:
+        _image_process_pool.shutdown(wait=False, cancel_futures=True)
+        _image_process_pool = None
 
-def get_gridfs() -> GridFS:
+
+# Ссылки на fire-and-forget задачи: без них event loop держит задачу только слабой
+# ссылкой, и незавершенную задачу может собрать GC
+_background_tasks: set[asyncio.Task] = set()
+
+
+def spawn_background_task(coro, description: str) -> asyncio.Task:
     """
-    Возвращает синхронный экземпляр GridFS для работы с файлами.
-    
-    GridFS используется синхронно в executor, поэтому нужен синхронный клиент.
+    Запускает фоновую задачу, хранит ссылку на нее до завершения и логирует ошибку.
+
+    Для работы внутри запроса лучше BackgroundTasks; эта функция - для задач,
+    которые не должны ждать конца ответа или живут дольше запроса.
     """
-    global _sync_client, _gridfs
-    
-    if _gridfs is None or _sync_client is None:
-        # Создаем синхронный клиент MongoDB для GridFS
-        # GridFS используется точечно, поэтому держим более "спокойный" пул,
-        # чтобы не раздувать auth/connect churn в логах Mongo.
-        uri_lower = settings.mongo_uri.lower()
-        use_tls = "mongodb.net" in uri_lower or "ssl=true" in uri_lower or "tls=true" in uri_lower
-        
-        client_config = {
-            "serverSelectionTimeoutMS": 30000,
-            "maxPoolSize": 20,
-            "minPoolSize": 1,
-            "maxIdleTimeMS": 1800000,
-            "connectTimeoutMS": 20000,
-            "socketTimeoutMS": 60000,
-            "retryWrites": True,
-            "retryReads": True,
-            "waitQueueTimeoutMS": 30000,
-            "appname": "dima-miniapp-gridfs",
-        }
-        
-        if use_tls:
-            client_config["tls"] = True
-        
-        _sync_client = MongoClient(settings.mongo_uri, **client_config)
-        _gridfs = GridFS(_sync_client[settings.mongo_db])
-    
-    return _gridfs
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+
+    def _on_done(t: asyncio.Task) -> None:
+        _background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logger.error(f"Фоновая задача '{description}' завершилась с ошибкой: {t.exception()}")
+
+    task.add_done_callback(_on_done)
+    return task
+
 
+def get_gridfs_content_type(grid_out, default: str) -> str:
+    """
+    Возвращает content type файла из GridFS.
 
-def close_gridfs_client() -> None:
-    """Закрывает sync MongoClient, используемый GridFS."""
-    global _sync_client, _gridfs
+    Файлы, загруженные через bucket, хранят его в metadata.contentType,
+    старые файлы (GridFS.put) - в поле contentType самого файла.
+    """
+    metadata = grid_out.metadata or {}
+    return metadata.get("contentType") or grid_out.content_type or default
 
-    if _sync_client is not None:
-        _sync_client.close()
 
-    _sync_client = None
-    _gridfs = None
+async def iter_gridfs_chunks(grid_out) -> AsyncIterator[bytes]:
+    """Отдает содержимое файла GridFS по одному чанку (для StreamingResponse)."""
+    while chunk := await grid_out.readchunk():
+        yield chunk
+
+
+def utcnow() -> datetime:
+    """
+    Текущее время UTC без tzinfo: в таком виде даты хранятся в MongoDB.
+
+    Замена устаревшему datetime.utcnow() (deprecated в Python 3.12).
+    """
+    return datetime.now(timezone.utc).replace(tzinfo=None)
 
 
 def as_object_id(value: str | ObjectId) -> ObjectId:
@@ -85,12 +137,47 @@ def as_object_id(value: str | ObjectId) -> ObjectId:
     """
     if isinstance(value, ObjectId):
         return value
+    # Строки (основной случай - id из URL/тела запроса) проверяем регуляркой,
+    # без конструирования и перехвата исключения на некорректных id
+    if isinstance(value, str):
+        if _OBJECT_ID_HEX_MATCH(value):
+            return _parse_object_id(value)
+        raise ValueError(f"Некорректный ObjectId: {value}")
     try:
         return ObjectId(value)
     except Exception as e:
         raise ValueError(f"Некорректный ObjectId: {value}") from e
 
 
+# Строковое представление ObjectId: ровно 24 hex-символа (компилируем один раз при импорте)
+_OBJECT_ID_HEX_MATCH = re.compile(r"[0-9a-fA-F]{24}").fullmatch
+
+
+# Одни и те же id (товары в корзине, вариации, заказы) разбираются много раз за запрос
+# и между запросами; преобразование строки в ObjectId чистое, поэтому инвалидация не нужна
+@functools.lru_cache(maxsize=4096)
+def _parse_object_id(value: str) -> ObjectId:
+    return ObjectId(value)
+
+
+def object_id_cache_stats() -> dict:
+    """Статистика кеша разбора ObjectId (попадания, промахи, заполненность) для мониторинга."""
+    info = _parse_object_id.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
+
+
+def is_object_id_str(value: str) -> bool:
+    """Проверяет, что строка - корректный ObjectId (24 hex-символа), без создания ObjectId."""
+    return _OBJECT_ID_HEX_MATCH(value) is not None
+
+
+# Разделители, допустимые в номере телефона: пробельные символы (как \s в re; последний
+# из них - U+3000) и "-()+". Таблица для str.translate строится один раз при импорте
+_PHONE_SEPARATORS_TABLE = str.maketrans(
+    "", "", "-()+" + "".join(char for char in map(chr, range(0x3001)) if char.isspace())
+)
+
+
 def validate_phone_number(phone: str) -> bool:
     """
     Валидирует номер телефона.
@@ -114,7 +201,7 @@ def validate_phone_number(phone: str) -> bool:
     has_plus = phone.strip().startswith('+')
     
     # Удаляем все пробелы, дефисы, скобки и другие символы
-    cleaned = re.sub(r'[\s\-\(\)\+]', '', phone)
+    cleaned = phone.translate(_PHONE_SEPARATORS_TABLE)
     
     # Проверяем, что остались только цифры
     if not cleaned.isdigit():
@@ -128,8 +215,8 @@ def validate_phone_number(phone: str) -> bool:
         # 11 цифр - должен начинаться с 7 или 8
         # Если был + в начале, то номер должен начинаться с 7
         if has_plus:
-            return cleaned.startswith('7')
-        return cleaned.startswith(('7', '8'))
+            return cleaned[0] == '7'
+        return cleaned[0] in '78'
     
     return False
 
@@ -139,29 +226,33 @@ def normalize_product_images(doc: dict) -> dict:
     
     Объединяет image и images в массив images, избегая дубликатов.
     Для обратной совместимости оставляет поле image как первый элемент массива.
+    Если документ уже нормализован, возвращается он сам, без копии.
     """
-    result = doc.copy()
-    images_list = []
-    
-    # Собираем все изображения
-    if "images" in doc and isinstance(doc["images"], list):
-        images_list = [img for img in doc["images"] if img]  # Фильтруем пустые значения
-    
-    if "image" in doc and doc["image"]:
+    images = doc.get("images")
+    image = doc.get("image")
+
+    # dict.fromkeys - упорядоченное множество: пустые значения и повторы убираются за O(n)
+    images_list = list(dict.fromkeys(img for img in images if img)) if isinstance(images, list) else []
+    if image and image not in images_list:
         # Добавляем image в начало массива, если его там еще нет
-        if doc["image"] not in images_list:
-            images_list.insert(0, doc["image"])
-    
-    # Обновляем поля
+        images_list.insert(0, image)
+
     if images_list:
+        # Частый случай: данные уже в нормализованном виде, копия не нужна
+        if images == images_list and image == images_list[0]:
+            return doc
+        result = doc.copy()
         result["images"] = images_list
         # Для обратной совместимости оставляем image как первый элемент
         result["image"] = images_list[0]
-    else:
-        # Если нет изображений, удаляем оба поля
-        result.pop("image", None)
-        result.pop("images", None)
-    
+        return result
+
+    # Если нет изображений, удаляем оба поля
+    if "image" not in doc and "images" not in doc:
+        return doc
+    result = doc.copy()
+    result.pop("image", None)
+    result.pop("images", None)
     return result
 
 
@@ -177,26 +268,53 @@ def serialize_doc(doc: dict | None) -> dict:
     """
     if doc is None:
         return {}
-    
+    # Частый случай - плоский документ (store_status, заказы без позиций в проекции):
+    # ObjectId только в _id, вложенных dict/list нет. Копия целиком делается на уровне C,
+    # остается привести один _id
+    if type(doc.get("_id")) is ObjectId:
+        serializers = _SERIALIZERS
+        if not any(type(value) in serializers for key, value in doc.items() if key != "_id"):
+            serialized = doc.copy()
+            serialized["_id"] = str(serialized["_id"])
+            return serialized
+    return _serialize_dict(doc)
+
+
+def _serialize_dict(doc: dict) -> dict:
+    # Диспетчеризация по точному type() вместо цепочки isinstance на каждое значение:
+    # большинство значений (str, int, float, datetime) проходят одним поиском в словаре
+    serializers = _SERIALIZERS
     serialized = {}
     for key, value in doc.items():
-        if isinstance(value, ObjectId):
-            serialized[key] = str(value)
-        elif isinstance(value, dict):
-            serialized[key] = serialize_doc(value)
-        elif isinstance(value, list):
-            serialized[key] = [
-                serialize_doc(item) if isinstance(item, dict) else (
-                    str(item) if isinstance(item, ObjectId) else item
-                )
-                for item in value
-            ]
-        else:
-            serialized[key] = value
-    
+        serializer = serializers.get(type(value))
+        serialized[key] = serializer(value) if serializer is not None else value
     return serialized
 
 
+def _serialize_list(values: list) -> list:
+    serializers = _SERIALIZERS
+    # Массивы в документах обычно однородные (variants - dict, images - str):
+    # тип проверяем одним проходом, а преобразование идет через map без ветвлений на элемент
+    if values:
+        element_type = type(values[0])
+        if all(type(value) is element_type for value in values):
+            serializer = serializers.get(element_type)
+            return list(values) if serializer is None else list(map(serializer, values))
+    serialized = [None] * len(values)
+    for index, value in enumerate(values):
+        serializer = serializers.get(type(value))
+        serialized[index] = serializer(value) if serializer is not None else value
+    return serialized
+
+
+# Motor возвращает документы как обычные dict/list, поэтому подклассы не учитываем
+_SERIALIZERS = {
+    ObjectId: str,
+    dict: _serialize_dict,
+    list: _serialize_list,
+}
+
+
 async def ensure_store_is_awake(db: AsyncIOMotorDatabase) -> None:
     """
     Проверяет, что магазин не в режиме сна.
@@ -205,11 +323,22 @@ async def ensure_store_is_awake(db: AsyncIOMotorDatabase) -> None:
         db: Подключение к базе данных
         
     Raises:
-        HTTPException: Если магазин в режиме сна
+        HTTPException: Если магазин в режиме сна или его статус не удалось проверить
     """
-    from fastapi import HTTPException, status
-    
-    store_status = await db.store_status.find_one({})
+    # Статус берем из кеша роутера store, если он прочитан из БД несколько секунд назад
+    # (кеш обновляется сразу при переключении режима сна), а не читаем store_status
+    # на каждый заказ. Fallback при ошибке БД заказ не пропускает.
+    # Импорт внутри функции: routers.store импортирует schemas, а те - utils
+    from .routers.store import get_store_status_for_order
+
+    try:
+        store_status = await get_store_status_for_order(db)
+    except PyMongoError as e:
+        logger.error(f"Не удалось проверить режим сна магазина перед заказом: {e}")
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Не удалось проверить статус магазина, попробуйте позже"
+        )
     if store_status and store_status.get("is_sleep_mode"):
         sleep_message = store_status.get("sleep_message") or "Магазин временно закрыт"
         raise HTTPException(
@@ -218,6 +347,55 @@ async def ensure_store_is_awake(db: AsyncIOMotorDatabase) -> None:
         )
 
 
+def _variant_quantity_expr(variant_id: str) -> dict:
+    """Выражение агрегации: текущий остаток варианта как int (нечисловое/отсутствующее - 0)."""
+    return {
+        "$convert": {
+            "input": {
+                "$arrayElemAt": [
+                    {
+                        "$map": {
+                            "input": {"$filter": {"input": "$variants", "as": "v", "cond": {"$eq": ["$$v.id", variant_id]}}},
+                            "as": "v",
+                            "in": "$$v.quantity",
+                        }
+                    },
+                    0,
+                ]
+            },
+            "to": "int",
+            "onError": 0,
+            "onNull": 0,
+        }
+    }
+
+
+def _element_quantity_expr() -> dict:
+    """Выражение агрегации: остаток элемента $$v массива variants как int (нечисловое/отсутствующее - 0)."""
+    return {"$convert": {"input": "$$v.quantity", "to": "int", "onError": 0, "onNull": 0}}
+
+
+def _set_variant_quantity_stage(variant_id: str, quantity_expr: dict) -> dict:
+    """Стадия pipeline-обновления: заменяет quantity варианта variant_id на quantity_expr."""
+    return {
+        "$set": {
+            "variants": {
+                "$map": {
+                    "input": "$variants",
+                    "as": "v",
+                    "in": {
+                        "$cond": [
+                            {"$eq": ["$$v.id", variant_id]},
+                            {"$mergeObjects": ["$$v", {"quantity": quantity_expr}]},
+                            "$$v",
+                        ]
+                    },
+                }
+            }
+        }
+    }
+
+
 async def decrement_variant_quantity(
     db: AsyncIOMotorDatabase,
     product_id: str,
@@ -239,64 +417,89 @@ async def decrement_variant_quantity(
     """
     try:
         product_oid = as_object_id(product_id)
-        # Сначала получаем текущее состояние товара для проверки количества после списания
-        product = await db.products.find_one(
-            {"_id": product_oid, "variants.id": variant_id},
-            {"variants": 1, "available": 1}
-        )
-
-        if not product:
-            return False
-
-        # Находим вариант и проверяем, достаточно ли товара
-        variant = next((v for v in product.get("variants", []) if v.get("id") == variant_id), None)
-        if not variant:
-            return False
-
-        try:
-            current_quantity = int(variant.get("quantity", 0))
-        except Exception:
-            current_quantity = 0
-
-        if current_quantity < quantity:
-            return False
-
-        new_quantity = current_quantity - quantity
-
-        # Уменьшаем количество варианта и сразу получаем обновлённый документ
-        # (единый round-trip вместо update + повторный find)
+        # Проверка остатка, списание и пересчет available - одна атомарная операция:
+        # условие $expr срабатывает только если остатка хватает, а pipeline-обновление
+        # уменьшает вариант и снимает товар с продажи, если ни у одного варианта не осталось остатка.
+        # Один round-trip и никакой гонки между параллельными заказами.
+        # Остатки приводятся через $convert: вариации не валидируются схемой, и quantity
+        # может храниться строкой ("10"), а в порядке BSON строка всегда больше числа
         updated_product = await db.products.find_one_and_update(
             {
                 "_id": product_oid,
                 "variants.id": variant_id,
+                "$expr": {"$gte": [_variant_quantity_expr(variant_id), quantity]},
             },
-            {
-                "$set": {"variants.$.quantity": new_quantity}
-            },
-            projection={"variants": 1},
+            [
+                _set_variant_quantity_stage(variant_id, {"$subtract": [_element_quantity_expr(), quantity]}),
+                {
+                    "$set": {
+                        "available": {
+                            "$cond": [
+                                {
+                                    "$gt": [
+                                        {"$max": {"$map": {"input": "$variants", "as": "v", "in": _element_quantity_expr()}}},
+                                        0,
+                                    ]
+                                },
+                                "$available",
+                                False,
+                            ]
+                        }
+                    }
+                },
+            ],
+            projection={"_id": 1},
             return_document=ReturnDocument.AFTER,
         )
 
         if not updated_product:
             return False
 
-        variants = updated_product.get("variants", [])
-        # Проверяем, есть ли хотя бы один вариант с quantity > 0
-        has_available_variant = any((v.get("quantity", 0) or 0) > 0 for v in variants)
-
-        # Если все варианты закончились, устанавливаем available = false
-        if not has_available_variant:
-            await db.products.update_one(
-                {"_id": product_oid},
-                {"$set": {"available": False}}
-            )
-
+        # Остатки вариантов входят в публичный каталог
+        invalidate_catalog_cache()
         return True
-    except Exception as e:
+    # Ловим только ошибки MongoDB и некорректный id (ValueError из as_object_id):
+    # ошибки в самом коде не должны маскироваться под "недостаточно товара"
+    except (PyMongoError, ValueError) as e:
         logger.error(f"Ошибка при уменьшении количества варианта: {e}")
         return False
 
 
+def _restore_variant_pipeline(variant_id: str, quantity: int) -> list[dict]:
+    """
+    Pipeline-обновление для возврата quantity единиц вариации на склад.
+
+    Одна операция вместо чтения и записи: сначала по старому остатку решаем, вернуть ли
+    товар в продажу (вариант был пуст, а станет > 0), затем прибавляем количество
+    к варианту. Нечисловой остаток считается нулем.
+    """
+    current_quantity = _variant_quantity_expr(variant_id)
+    return [
+        {
+            "$set": {
+                "available": {
+                    "$cond": [
+                        {
+                            "$and": [
+                                {"$lte": [current_quantity, 0]},
+                                {"$gt": [{"$add": [current_quantity, quantity]}, 0]},
+                            ]
+                        },
+                        True,
+                        "$available",
+                    ]
+                }
+            }
+        },
+        _set_variant_quantity_stage(
+            variant_id,
+            {
+                "$add": [_element_quantity_expr(), quantity]
+            },
+        ),
+    ]
+
+
 async def restore_variant_quantity(
     db: AsyncIOMotorDatabase,
     product_id: str,
@@ -315,107 +518,193 @@ async def restore_variant_quantity(
     """
     try:
         product_oid = as_object_id(product_id)
-
-        # Получаем текущее состояние товара одним round-trip: читаем и блокируем
-        # значение варианта перед расчётом нового количества.
-        product = await db.products.find_one(
+        result = await db.products.update_one(
             {"_id": product_oid, "variants.id": variant_id},
-            {"variants": 1, "available": 1}
+            _restore_variant_pipeline(variant_id, quantity),
         )
 
-        if not product:
+        if result.matched_count == 0:
             logger.warning(f"Товар {product_id} или вариант {variant_id} не найден при восстановлении количества")
             return
 
-        # Находим вариант и получаем текущее количество
-        variant = next((v for v in product.get("variants", []) if v.get("id") == variant_id), None)
-        if not variant:
-            logger.warning(f"Вариант {variant_id} не найден в товаре {product_id}")
-            return
+        invalidate_catalog_cache()
+    except (PyMongoError, ValueError) as e:
+        logger.error(f"Ошибка при восстановлении количества варианта: {e}")
 
-        current_quantity = variant.get("quantity", 0)
-        was_unavailable = current_quantity <= 0
 
+async def restore_variant_quantities(
+    db: AsyncIOMotorDatabase,
+    items: list[dict]
+) -> None:
+    """
+    Возвращает на склад все позиции корзины или заказа одним bulk_write.
+    
+    Вместо отдельного запроса на каждую позицию - один round-trip на весь список.
+    Позиции без variant_id или с некорректным product_id пропускаются.
+    
+    Args:
+        db: Подключение к базе данных
+        items: Позиции (словари с product_id, variant_id и quantity)
+    """
+    operations = []
+    for item in items:
+        product_id = item.get("product_id")
+        variant_id = item.get("variant_id")
+        if not product_id or not variant_id:
+            continue
         try:
-            numeric_current = int(current_quantity)
-        except Exception:
-            numeric_current = 0
-
-        new_quantity = numeric_current + quantity
-
-        # Восстанавливаем количество варианта и, если нужно, сразу делаем товар
-        # доступным (available = true) одной атомарной операцией обновления.
-        update_ops: dict = {
-            "$set": {"variants.$.quantity": new_quantity}
-        }
-        if was_unavailable and new_quantity > 0:
-            update_ops["$set"]["available"] = True
+            product_oid = as_object_id(product_id)
+        except ValueError:
+            logger.warning(f"Некорректный ID товара {product_id} при восстановлении количества")
+            continue
+        operations.append(
+            UpdateOne(
+                {"_id": product_oid, "variants.id": variant_id},
+                _restore_variant_pipeline(variant_id, item.get("quantity", 0)),
+            )
+        )
+    if not operations:
+        return
 
-        await db.products.update_one(
-            {
-                "_id": product_oid,
-                "variants.id": variant_id
-            },
-            update_ops
+    try:
+        # ordered=False: отсутствие одного товара не мешает вернуть остальные
+        result = await db.products.bulk_write(operations, ordered=False)
+    except PyMongoError as e:
+        logger.error(f"Ошибка при восстановлении количества вариантов ({len(operations)} шт.): {e}")
+        return
+    if result.matched_count < len(operations):
+        logger.warning(
+            f"При восстановлении количества не найдено товаров или вариантов: "
+            f"{len(operations) - result.matched_count} из {len(operations)}"
         )
-    except Exception as e:
-        logger.error(f"Ошибка при восстановлении количества варианта: {e}")
+    invalidate_catalog_cache()
 
 
 async def mark_order_as_deleted(
     db: AsyncIOMotorDatabase,
-    order_id: str
-) -> bool:
+    order_id: str,
+    projection: Optional[dict] = None
+) -> Optional[dict]:
     """
     Помечает заказ как удаленный (мягкое удаление).
     
+    Обновление и чтение результата - один find_one_and_update, без повторного
+    запроса заказа после пометки.
+    
     Args:
         db: Подключение к базе данных
         order_id: ID заказа
+        projection: Поля обновленного заказа для возврата (по умолчанию только _id)
         
     Returns:
-        True если операция успешна, False в противном случае
+        Обновленный заказ или None, если заказ не найден или произошла ошибка
     """
     try:
         order_oid = as_object_id(order_id)
-        result = await db.orders.update_one(
+        return await db.orders.find_one_and_update(
             {"_id": order_oid},
-            {
-                "$set": {"deleted_at": datetime.now(timezone.utc).replace(tzinfo=None)}
-            }
+            {"$set": {"deleted_at": utcnow()}},
+            projection=projection or {"_id": 1},
+            return_document=ReturnDocument.AFTER,
         )
-        return result.modified_count > 0
-    except Exception as e:
+    except (PyMongoError, ValueError) as e:
         logger.error(f"Ошибка при пометке заказа как удаленного: {e}")
-        return False
+        return None
 
 
 async def restore_order_entry(
     db: AsyncIOMotorDatabase,
-    order_id: str
-) -> bool:
+    order_id: str,
+    projection: Optional[dict] = None
+) -> Optional[dict]:
     """
     Восстанавливает удаленный заказ (убирает пометку об удалении).
     
     Args:
         db: Подключение к базе данных
         order_id: ID заказа
+        projection: Поля восстановленного заказа для возврата (по умолчанию только _id)
         
     Returns:
-        True если операция успешна, False в противном случае
+        Восстановленный заказ или None, если удаленный заказ не найден или произошла ошибка
     """
     try:
         order_oid = as_object_id(order_id)
-        result = await db.orders.update_one(
-            {"_id": order_oid},
-            {
-                "$unset": {"deleted_at": ""}
-            }
+        return await db.orders.find_one_and_update(
+            {"_id": order_oid, "deleted_at": {"$exists": True}},
+            {"$unset": {"deleted_at": ""}},
+            projection=projection or {"_id": 1},
+            return_document=ReturnDocument.AFTER,
         )
-        return result.modified_count > 0
-    except Exception as e:
+    except (PyMongoError, ValueError) as e:
         logger.error(f"Ошибка при восстановлении заказа: {e}")
-        return False
+        return None
+
+
+# Чанки удаляемых файлов - мусор: после удаления записи в fs.files они уже недоступны,
+# поэтому их удаление не ждет подтверждения сервера (w=0)
+_UNACKNOWLEDGED_WRITE_CONCERN = WriteConcern(w=0)
+
+
+async def delete_gridfs_files_bulk(db: AsyncIOMotorDatabase, file_ids: list[ObjectId]) -> None:
+    """
+    Удаляет пачку файлов GridFS двумя запросами (fs.files и fs.chunks) на всю пачку.
+
+    GridFSBucket.delete делает те же два запроса, но на каждый файл. Метаданные
+    удаляются первыми, как и в GridFSBucket.delete: файл без записи в fs.files недоступен.
+    Удаление fs.files подтверждается (ошибки видны вызывающему коду), а чанки удаляются
+    без подтверждения: потерянное удаление оставит лишь недоступные чанки.
+    """
+    if not file_ids:
+        return
+    await db["fs.files"].delete_many({"_id": {"$in": file_ids}})
+    chunks = db.get_collection("fs.chunks", write_concern=_UNACKNOWLEDGED_WRITE_CONCERN)
+    await chunks.delete_many({"files_id": {"$in": file_ids}})
+
+
+async def permanently_delete_order_entries(
+    db: AsyncIOMotorDatabase,
+    order_docs: list[dict]
+) -> int:
+    """
+    Окончательно удаляет пачку заказов из базы данных.
+    
+    Файлы чеков удаляются пачкой через delete_gridfs_files_bulk, а заказы - одним
+    delete_many, и обе операции идут параллельно: ожидание - примерно два round-trip
+    на всю пачку вместо трех последовательных на каждый заказ.
+    
+    Args:
+        db: Подключение к базе данных
+        order_docs: Документы заказов (нужны поля _id и payment_receipt_file_id)
+        
+    Returns:
+        Количество удаленных заказов
+    """
+    order_ids = [doc["_id"] for doc in order_docs if doc.get("_id") is not None]
+    receipt_file_ids = [
+        ObjectId(file_id)
+        for file_id in (doc.get("payment_receipt_file_id") for doc in order_docs)
+        if file_id and is_object_id_str(str(file_id))
+    ]
+    
+    async def delete_receipts() -> None:
+        # Ошибка удаления чеков не должна мешать удалению заказов: только логируем
+        try:
+            await delete_gridfs_files_bulk(db, receipt_file_ids)
+        except PyMongoError as e:
+            logger.error(f"Ошибка при удалении файлов чеков ({len(receipt_file_ids)} шт.): {e}")
+
+    async def delete_orders() -> int:
+        if not order_ids:
+            return 0
+        result = await db.orders.delete_many({"_id": {"$in": order_ids}})
+        return result.deleted_count
+
+    # Чеки и заказы удаляем параллельно: операции не зависят друг от друга
+    _, deleted_count = await asyncio.gather(delete_receipts(), delete_orders())
+    if deleted_count:
+        logger.info(f"Окончательно удалено заказов: {deleted_count}")
+    return deleted_count
 
 
 async def permanently_delete_order_entry(
@@ -431,27 +720,151 @@ async def permanently_delete_order_entry(
         db: Подключение к базе данных
         order_doc: Документ заказа
     """
-    import asyncio
+    try:
+        await permanently_delete_order_entries(db, [order_doc])
+    except PyMongoError as e:
+        logger.error(f"Ошибка при окончательном удалении заказа {order_doc.get('_id')}: {e}")
+
+
+# Маркеры SOF (Start Of Frame) JPEG с размерами кадра: C0-CF, кроме DHT (C4), JPG (C8) и DAC (CC)
+_JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# JPEG с плотностью не выше этой (байт на пиксель) уже сжат примерно как при quality 85:
+# повторное кодирование почти ничего не выигрывает, а стоит полного декодирования
+_JPEG_PASSTHROUGH_BYTES_PER_PIXEL = 0.5
+
+
+def _probe_image_size(image_bytes: bytes) -> Optional[tuple[str, int, int]]:
+    """
+    Определяет формат и размеры JPEG/PNG только по заголовкам, без декодирования.
+
+    Returns:
+        (формат, ширина, высота) или None, если формат другой или заголовок не разобран
+    """
+    # PNG: сигнатура (8 байт), затем первым идет чанк IHDR с шириной и высотой
+    if image_bytes[:8] == b"\x89PNG\r\n\x1a\n" and image_bytes[12:16] == b"IHDR":
+        width, height = struct.unpack(">II", image_bytes[16:24])
+        return "PNG", width, height
+
+    # JPEG: после SOI (FFD8) идут сегменты "FF <маркер> <длина>", ищем первый SOF
+    if image_bytes[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    size = len(image_bytes)
+    while pos + 9 <= size:
+        if image_bytes[pos] != 0xFF:
+            return None
+        marker = image_bytes[pos + 1]
+        if marker == 0xFF:
+            # Байты-заполнители перед маркером
+            pos += 1
+            continue
+        if marker in _JPEG_SOF_MARKERS:
+            # Сегмент SOF: длина (2), точность (1), высота (2), ширина (2)
+            height, width = struct.unpack(">HH", image_bytes[pos + 5:pos + 9])
+            return "JPEG", width, height
+        if marker == 0xD9 or marker == 0xDA:
+            # Конец изображения или начало данных скана, а SOF так и не встретился
+            return None
+        segment_length = struct.unpack(">H", image_bytes[pos + 2:pos + 4])[0]
+        pos += 2 + segment_length
+    return None
+
+
+def _can_skip_compression(image_bytes: bytes, max_width: int, max_height: int, format: str) -> bool:
+    """
+    Проверяет по заголовкам, что изображение уже в целевом формате и размерах.
+
+    Такой файл отдаем как есть: ни Pillow, ни libvips не вызываются.
+    """
+    probe = _probe_image_size(image_bytes)
+    if probe is None:
+        return False
+    source_format, width, height = probe
+    if source_format != format or width > max_width or height > max_height:
+        return False
+    if format == "JPEG":
+        return len(image_bytes) <= width * height * _JPEG_PASSTHROUGH_BYTES_PER_PIXEL
+    # PNG сжимается без потерь: перекодирование в пределах размеров почти не уменьшает файл
+    return True
+
+
+def _compress_with_vips(
+    image_bytes: bytes,
+    max_width: int,
+    max_height: int,
+    quality: int,
+    format: str,
+) -> bytes:
+    """Сжимает JPEG/WEBP через libvips: уменьшение при декодировании, без полной копии в памяти Python."""
+    img = _get_pyvips().Image.thumbnail_buffer(image_bytes, max_width, height=max_height, size="down")
+    if format == "JPEG":
+        # JPEG не поддерживает прозрачность: кладем на белый фон, как и в ветке Pillow
+        if img.hasalpha():
+            img = img.flatten(background=[255, 255, 255])
+        return img.write_to_buffer(f".jpg[Q={quality},strip,optimize_coding]")
+    return img.write_to_buffer(f".webp[Q={quality},strip]")
+
+
+def _compress_with_pillow(
+    image_bytes: bytes,
+    max_width: int,
+    max_height: int,
+    quality: int,
+    format: str,
+) -> bytes:
+    """Сжимает изображение через Pillow (PNG и fallback, если libvips недоступен)."""
+    # Pillow импортируем лениво: он нужен только при загрузке изображений,
+    # а utils импортируется каждым роутером при старте приложения
+    from PIL import Image
+
+    # Открываем изображение из байтов
+    img = Image.open(io.BytesIO(image_bytes))
     
-    order_id = str(order_doc.get("_id"))
-    receipt_file_id = order_doc.get("payment_receipt_file_id")
+    # Если изображение уже маленькое по размерам, пропускаем изменение размера
+    needs_resize = img.width > max_width or img.height > max_height
     
-    # Удаляем файл чека из GridFS, если он есть
-    if receipt_file_id:
-        try:
-            fs = get_gridfs()
-            loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, lambda: fs.delete(ObjectId(receipt_file_id)))
-        except Exception as e:
-            logger.error(f"Ошибка при удалении файла чека {receipt_file_id}: {e}")
+    # Большой JPEG декодируем сразу в уменьшенном масштабе (DCT-scaling в libjpeg):
+    # в разы меньше CPU и памяти, чем полное декодирование и затем resize.
+    # Запас 2x (как reducing_gap=2.0 у thumbnail) оставляет LANCZOS достаточно пикселей:
+    # DCT-масштабирование само по себе сглаживает грубее
+    if needs_resize and img.format == "JPEG":
+        img.draft("RGB", (max_width * 2, max_height * 2))
     
-    # Удаляем заказ из базы данных
-    try:
-        order_oid = as_object_id(order_id)
-        await db.orders.delete_one({"_id": order_oid})
-        logger.info(f"Заказ {order_id} окончательно удален")
-    except Exception as e:
-        logger.error(f"Ошибка при окончательном удалении заказа {order_id}: {e}")
+    # Для JPEG: прозрачные изображения (палитра, LA) приводим к RGBA, остальные - к RGB
+    if format == "JPEG" and img.mode in ("RGBA", "LA", "P"):
+        if img.mode != "RGBA":
+            img = img.convert("RGBA")
+    elif img.mode != "RGB" and format == "JPEG":
+        img = img.convert("RGB")
+    
+    # Изменяем размер, если изображение слишком большое
+    if needs_resize:
+        img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
+    
+    # Прозрачность для JPEG убираем уже после уменьшения (меньше пикселей): кладем на белый
+    # фон, маской служит само RGBA-изображение (его альфа), без копии канала через split()
+    if format == "JPEG" and img.mode == "RGBA":
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        background.paste(img, mask=img)
+        img = background
+    
+    # Сохраняем в буфер
+    output = io.BytesIO()
+    
+    if format == "JPEG":
+        img.save(output, format="JPEG", quality=quality, optimize=True)
+    elif format == "PNG":
+        # optimize=True перебирает несколько вариантов сжатия и в разы медленнее,
+        # а на фото почти не уменьшает файл: одного прохода zlib уровня 6 достаточно
+        img.save(output, format="PNG", compress_level=6)
+    elif format == "WEBP":
+        img.save(output, format="WEBP", quality=quality, method=6)
+    else:
+        img.save(output, format=format, quality=quality)
+    
+    compressed_bytes = output.getvalue()
+    output.close()
+    return compressed_bytes
 
 
 def compress_image_bytes(
@@ -480,42 +893,16 @@ def compress_image_bytes(
     if len(image_bytes) < min_size_to_compress:
         return image_bytes
     
+    # Уже оптимизированный файл в нужном формате и размерах не перекодируем
+    if _can_skip_compression(image_bytes, max_width, max_height, format):
+        logger.debug("Изображение уже в целевом формате и размерах, сжатие пропущено")
+        return image_bytes
+    
     try:
-        # Открываем изображение из байтов
-        img = Image.open(io.BytesIO(image_bytes))
-        
-        # Если изображение уже маленькое по размерам, пропускаем изменение размера
-        needs_resize = img.width > max_width or img.height > max_height
-        
-        # Конвертируем RGBA в RGB для JPEG (если нужно)
-        if format == "JPEG" and img.mode in ("RGBA", "LA", "P"):
-            # Создаем белый фон для прозрачных изображений
-            background = Image.new("RGB", img.size, (255, 255, 255))
-            if img.mode == "P":
-                img = img.convert("RGBA")
-            background.paste(img, mask=img.split()[-1] if img.mode == "RGBA" else None)
-            img = background
-        elif img.mode != "RGB" and format == "JPEG":
-            img = img.convert("RGB")
-        
-        # Изменяем размер, если изображение слишком большое
-        if needs_resize:
-            img.thumbnail((max_width, max_height), Image.Resampling.LANCZOS)
-        
-        # Сохраняем в буфер
-        output = io.BytesIO()
-        
-        if format == "JPEG":
-            img.save(output, format="JPEG", quality=quality, optimize=True)
-        elif format == "PNG":
-            img.save(output, format="PNG", optimize=True)
-        elif format == "WEBP":
-            img.save(output, format="WEBP", quality=quality, method=6)
+        if format in ("JPEG", "WEBP") and _get_pyvips() is not None:
+            compressed_bytes = _compress_with_vips(image_bytes, max_width, max_height, quality, format)
         else:
-            img.save(output, format=format, quality=quality)
-        
-        compressed_bytes = output.getvalue()
-        output.close()
+            compressed_bytes = _compress_with_pillow(image_bytes, max_width, max_height, quality, format)
         
         # Если сжатие не дало результата (файл стал больше), возвращаем оригинал
         if len(compressed_bytes) >= len(image_bytes):
@@ -538,119 +925,56 @@ def compress_image_bytes(
         return image_bytes
 
 
-def compress_base64_image(
-    base64_string: str,
-    max_width: int = 1920,
-    max_height: int = 1920,
-    quality: int = 85,
-    min_size_to_compress: int = 100 * 1024  # 100 КБ - минимальный размер для сжатия
-) -> Optional[str]:
+def _parse_base64_image(base64_string: str) -> tuple[str, str, str, str]:
     """
-    Сжимает изображение из base64 строки и возвращает сжатую base64 строку.
-    
-    Args:
-        base64_string: Base64 строка изображения (может содержать data URL префикс)
-        max_width: Максимальная ширина (по умолчанию 1920px)
-        max_height: Максимальная высота (по умолчанию 1920px)
-        quality: Качество JPEG (1-100, по умолчанию 85)
-        min_size_to_compress: Минимальный размер файла для сжатия (по умолчанию 100 КБ)
-        
+    Разбирает base64 строку изображения (может содержать data URL префикс).
+
     Returns:
-        Сжатая base64 строка с data URL префиксом или None в случае ошибки
+        (данные base64, формат для сжатия, MIME-тип, расширение файла)
     """
-    if not base64_string:
-        return None
-    
-    try:
-        # Убираем data URL префикс, если есть (data:image/jpeg;base64,...)
-        if "," in base64_string:
-            header, data = base64_string.split(",", 1)
-            # Определяем формат из заголовка
-            if "jpeg" in header.lower() or "jpg" in header.lower():
-                format = "JPEG"
-            elif "png" in header.lower():
-                format = "PNG"
-            elif "webp" in header.lower():
-                format = "WEBP"
-            else:
-                format = "JPEG"  # По умолчанию JPEG
-        else:
-            data = base64_string
-            format = "JPEG"  # По умолчанию JPEG
-        
-        # Декодируем base64
-        image_bytes = base64.b64decode(data)
-        
-        # Если файл уже маленький, возвращаем оригинал без сжатия
-        if len(image_bytes) < min_size_to_compress:
-            return base64_string
-        
-        # Сжимаем изображение
-        compressed_bytes = compress_image_bytes(
-            image_bytes,
-            max_width=max_width,
-            max_height=max_height,
-            quality=quality,
-            format=format,
-            min_size_to_compress=min_size_to_compress
-        )
-        
-        # Если сжатие не дало результата, возвращаем оригинал
-        if len(compressed_bytes) >= len(image_bytes):
-            return base64_string
-        
-        # Кодируем обратно в base64
-        compressed_base64 = base64.b64encode(compressed_bytes).decode("utf-8")
-        
-        # Возвращаем с data URL префиксом
-        mime_type = f"image/{format.lower()}" if format != "JPEG" else "image/jpeg"
-        return f"data:{mime_type};base64,{compressed_base64}"
-    except Exception as e:
-        logger.error(f"Ошибка при сжатии base64 изображения: {e}")
-        # В случае ошибки возвращаем оригинальную строку
-        return base64_string
+    if "," in base64_string:
+        header, data = base64_string.split(",", 1)
+        header = header.lower()
+        # Определяем формат из заголовка
+        if "png" in header:
+            return data, "PNG", "image/png", ".png"
+        if "webp" in header:
+            return data, "WEBP", "image/webp", ".webp"
+        return data, "JPEG", "image/jpeg", ".jpg"
+    return base64_string, "JPEG", "image/jpeg", ".jpg"
 
 
-async def compress_base64_image_async(
+def _decode_and_compress_base64_image(
     base64_string: str,
-    max_width: int = 1920,
-    max_height: int = 1920,
-    quality: int = 85
-) -> Optional[str]:
+    max_width: int,
+    max_height: int,
+    quality: int,
+) -> tuple[bytes, str, str]:
     """
-    Асинхронно сжимает изображение из base64 строки.
-    Выполняет сжатие в executor, чтобы не блокировать event loop.
-    
-    Args:
-        base64_string: Base64 строка изображения (может содержать data URL префикс)
-        max_width: Максимальная ширина (по умолчанию 1920px)
-        max_height: Максимальная высота (по умолчанию 1920px)
-        quality: Качество JPEG (1-100, по умолчанию 85)
-        
+    Декодирует и сжимает base64 изображение (CPU-bound, выполняется в процессе пула).
+
     Returns:
-        Сжатая base64 строка с data URL префиксом или None в случае ошибки
+        (сжатые байты, MIME-тип, расширение файла)
     """
-    if not base64_string:
-        return None
-    
-    import asyncio
-    
-    loop = asyncio.get_event_loop()
-    try:
-        # Выполняем сжатие в executor, чтобы не блокировать event loop
-        result = await loop.run_in_executor(
-            None,
-            compress_base64_image,
-            base64_string,
-            max_width,
-            max_height,
-            quality
-        )
-        return result
-    except Exception as e:
-        logger.error(f"Ошибка при асинхронном сжатии base64 изображения: {e}")
-        # В случае ошибки возвращаем оригинальную строку
-        return base64_string
+    data, format, mime_type, extension = _parse_base64_image(base64_string)
+    # Base64 декодируется один раз, дальше до GridFS идут только байты
+    image_bytes = pybase64.b64decode(data) if HAS_PYBASE64 else base64.b64decode(data)
+    compressed_bytes = compress_image_bytes(image_bytes, max_width, max_height, quality, format)
+    return compressed_bytes, mime_type, extension
+
+
+async def _put_product_image(bucket, image_bytes: bytes, mime_type: str, extension: str) -> str:
+    """Сохраняет готовое изображение товара в GridFS через асинхронный bucket."""
+    file_id = await bucket.upload_from_stream(
+        f"{uuid4().hex}{extension}",
+        image_bytes,
+        metadata={
+            "contentType": mime_type,
+            "uploaded_at": utcnow(),
+            "source": "product_image",
+        },
+    )
+    return str(file_id)
 
 
 async def save_base64_image_to_gridfs(
@@ -673,75 +997,8 @@ async def save_base64_image_to_gridfs(
     """
     if not base64_string:
         return None
-    
-    import asyncio
-    from uuid import uuid4
-    
-    try:
-        loop = asyncio.get_event_loop()
-        fs = get_gridfs()
-        
-        # Определяем формат и декодируем base64
-        if "," in base64_string:
-            header, data = base64_string.split(",", 1)
-            # Определяем формат из заголовка
-            if "jpeg" in header.lower() or "jpg" in header.lower():
-                format = "JPEG"
-                mime_type = "image/jpeg"
-                extension = ".jpg"
-            elif "png" in header.lower():
-                format = "PNG"
-                mime_type = "image/png"
-                extension = ".png"
-            elif "webp" in header.lower():
-                format = "WEBP"
-                mime_type = "image/webp"
-                extension = ".webp"
-            else:
-                format = "JPEG"
-                mime_type = "image/jpeg"
-                extension = ".jpg"
-        else:
-            data = base64_string
-            format = "JPEG"
-            mime_type = "image/jpeg"
-            extension = ".jpg"
-        
-        # Декодируем base64
-        image_bytes = base64.b64decode(data)
-        
-        # Сжимаем изображение если нужно
-        compressed_bytes = await loop.run_in_executor(
-            None,
-            compress_image_bytes,
-            image_bytes,
-            max_width,
-            max_height,
-            quality,
-            format
-        )
-        
-        # Генерируем уникальное имя файла
-        filename = f"{uuid4().hex}{extension}"
-        
-        # Сохраняем в GridFS (синхронная операция в executor)
-        file_id = await loop.run_in_executor(
-            None,
-            lambda: fs.put(
-                compressed_bytes,
-                filename=filename,
-                content_type=mime_type,
-                metadata={
-                    "uploaded_at": datetime.now(timezone.utc).replace(tzinfo=None),
-                    "source": "product_image",
-                },
-            ),
-        )
-        
-        return str(file_id)
-    except Exception as e:
-        logger.error(f"Ошибка при сохранении base64 изображения в GridFS: {e}")
-        return None
+    file_ids = await save_base64_images_to_gridfs([base64_string], max_width, max_height, quality)
+    return file_ids[0] if file_ids else None
 
 
 async def save_base64_images_to_gridfs(
@@ -752,6 +1009,9 @@ async def save_base64_images_to_gridfs(
 ) -> List[str]:
     """
     Сохраняет список base64 изображений в GridFS и возвращает список file_id.
+
+    Декодирование и сжатие всех изображений идут параллельно в пуле процессов
+    (GIL не мешает использовать все ядра), затем файлы пишутся через асинхронный bucket.
     
     Args:
         base64_strings: Список base64 строк изображений
@@ -760,65 +1020,79 @@ async def save_base64_images_to_gridfs(
         quality: Качество JPEG (1-100, по умолчанию 85)
         
     Returns:
-        Список file_id (строки), None значения пропускаются
+        Список file_id (строки), изображения с ошибкой пропускаются
     """
+    base64_strings = [b64 for b64 in base64_strings or [] if b64]
     if not base64_strings:
         return []
-    
-    results = []
-    for base64_str in base64_strings:
-        if base64_str:
-            file_id = await save_base64_image_to_gridfs(
-                base64_str, max_width, max_height, quality
-            )
-            if file_id:
-                results.append(file_id)
-    
-    return results
 
+    bucket = await get_gridfs_bucket()
+    if bucket is None:
+        logger.error("Не удалось сохранить изображения в GridFS: база данных недоступна")
+        return []
 
-def _delete_gridfs_file(file_id: str) -> None:
-    """
-    Вспомогательная функция для синхронного удаления файла из GridFS.
-    
-    Args:
-        file_id: ID файла в GridFS
-    """
-    fs = get_gridfs()
-    fs.delete(ObjectId(file_id))
+    loop = asyncio.get_running_loop()
+    pool = get_image_process_pool()
+    prepared = await asyncio.gather(
+        *(
+            loop.run_in_executor(pool, _decode_and_compress_base64_image, b64, max_width, max_height, quality)
+            for b64 in base64_strings
+        ),
+        return_exceptions=True,
+    )
+
+    images = []
+    for result in prepared:
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка при обработке base64 изображения: {result}")
+        else:
+            images.append(result)
+
+    saved = await asyncio.gather(
+        *(_put_product_image(bucket, *image) for image in images),
+        return_exceptions=True,
+    )
+
+    # Порядок file_id совпадает с порядком изображений в запросе
+    results = []
+    for result in saved:
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка при сохранении base64 изображения в GridFS: {result}")
+        else:
+            results.append(result)
+    return results
 
 
 async def delete_product_images_from_gridfs(
-    product_doc: dict
+    db: AsyncIOMotorDatabase,
+    product_docs: list[dict]
 ) -> None:
     """
-    Удаляет изображения товара из GridFS.
+    Удаляет изображения товаров из GridFS.
+    
+    Изображения всех переданных товаров удаляются одной пачкой (два запроса),
+    поэтому удаление категории не зависит от числа товаров и изображений.
     
     Args:
-        product_doc: Документ товара с полями image и images
-    """
-    import asyncio
-    
-    loop = asyncio.get_event_loop()
-    
-    # Удаляем основное изображение
-    if product_doc.get("image"):
-        image_id = product_doc["image"]
-        # Проверяем, что это не base64 строка (старые данные)
-        if isinstance(image_id, str) and not image_id.startswith("data:image") and ObjectId.is_valid(image_id):
-            try:
-                await loop.run_in_executor(None, _delete_gridfs_file, image_id)
-                logger.debug(f"Удалено основное изображение товара: {image_id}")
-            except Exception as e:
-                logger.error(f"Ошибка при удалении основного изображения товара {image_id}: {e}")
-    
-    # Удаляем дополнительные изображения
-    if product_doc.get("images") and isinstance(product_doc["images"], list):
-        for image_id in product_doc["images"]:
-            # Проверяем, что это не base64 строка (старые данные)
-            if isinstance(image_id, str) and not image_id.startswith("data:image") and ObjectId.is_valid(image_id):
-                try:
-                    await loop.run_in_executor(None, _delete_gridfs_file, image_id)
-                    logger.debug(f"Удалено дополнительное изображение товара: {image_id}")
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении дополнительного изображения товара {image_id}: {e}")
+        db: Подключение к базе данных
+        product_docs: Документы товаров с полями image и images
+    """
+    image_ids = []
+    for product_doc in product_docs:
+        image_ids.append(product_doc.get("image"))
+        if isinstance(product_doc.get("images"), list):
+            image_ids.extend(product_doc["images"])
+    # Старые base64 строки и пустые значения отсекает проверка на ObjectId;
+    # dict.fromkeys убирает повтор, если основное изображение есть и в images
+    file_ids = [
+        ObjectId(image_id) for image_id in dict.fromkeys(image_ids)
+        if isinstance(image_id, str) and is_object_id_str(image_id)
+    ]
+    if not file_ids:
+        return
+
+    try:
+        await delete_gridfs_files_bulk(db, file_ids)
+        logger.debug(f"Удалено изображений товаров: {len(file_ids)}")
+    except PyMongoError as e:
+        logger.error(f"Ошибка при удалении изображений товаров ({len(file_ids)} шт.): {e}")